@@ -0,0 +1,46 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shared helpers of the benchmarks that exercise the functions modules
+# These need the packages of requirements.txt, but no config.ini
+
+import sys
+from threading import Lock
+from timeit import Timer
+from types import ModuleType
+from typing import Callable
+
+import plugins
+from plugins.locks import RWLock
+
+
+def get_time(func: Callable, *args) -> float:
+    # Get the seconds per call of the function
+    number, total = Timer(lambda: func(*args)).autorange()
+    return total / number
+
+
+def stub_glovar(**values) -> ModuleType:
+    # Install a glovar with the given values before the functions modules are imported
+    result = ModuleType("plugins.glovar")
+    result.locks = {"hint": Lock(), "message": RWLock(), "trust": Lock()}
+    result.__dict__.update(values)
+    sys.modules["plugins.glovar"] = result
+    plugins.glovar = result
+
+    return result
@@ -0,0 +1,86 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Join latency under contention, the global message lock against the striped group and user locks
+# Run from the repository root: python bench/message_lock.py
+
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from os.path import abspath, dirname
+from random import shuffle
+from threading import Lock
+from time import perf_counter, sleep
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from plugins.locks import RWLock, StripedLock
+
+GROUPS = 50
+JOINS = 10
+WORKERS = 16
+CALL = 0.02
+
+
+def measure(name: str, striped: bool) -> None:
+    # Print the total time, the p99 latency of a join from lock request to release, and the p99 time since the start
+    message_lock = RWLock()
+    global_lock = Lock()
+    group_locks = StripedLock()
+    user_locks = StripedLock()
+
+    joins = [(-1001000000000 - gid, gid * JOINS + i) for gid in range(GROUPS) for i in range(JOINS)]
+    shuffle(joins)
+    begin = perf_counter()
+
+    def join(gid: int, uid: int) -> tuple:
+        start = perf_counter()
+
+        if striped:
+            message_lock.acquire_shared()
+            held = (group_locks.acquire([gid]), user_locks.acquire([uid]))
+
+            try:
+                sleep(CALL)
+            finally:
+                user_locks.release(held[1])
+                group_locks.release(held[0])
+                message_lock.release_shared()
+        else:
+            with global_lock:
+                sleep(CALL)
+
+        return perf_counter() - start, perf_counter() - begin
+
+    with ThreadPoolExecutor(WORKERS) as executor:
+        results = list(executor.map(lambda args: join(*args), joins))
+
+    total = perf_counter() - begin
+    index = int(len(results) * 0.99) - 1
+    held = sorted(result[0] for result in results)[index]
+    done = sorted(result[1] for result in results)[index]
+    print(f"{name:>11}: total {total:.2f} s, p99 latency {held * 1000:.0f} ms, p99 done after {done * 1000:.0f} ms")
+
+
+def main() -> None:
+    print(f"{GROUPS} groups, {JOINS} joins each, {WORKERS} threads, {CALL * 1000:.0f} ms per call")
+    measure("global lock", False)
+    measure("striped", True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Dump and load time and size of the data files, pickle against marshal
+# Run from the repository root: python bench/serializers.py [users]
+
+import sys
+from os.path import abspath, dirname
+from time import perf_counter
+from typing import Any, Callable
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from plugins.records import UserStatus
+from plugins.storage import dumps_data, loads_data
+
+
+def get_flood_logs(count: int) -> dict:
+    # Get flood log rows in 100 groups
+    return {-1001000000000 - gid: [{"user id": uid, "time": 205001011200 + uid, "action": "kick",
+                                    "reason": "timeout", "message id": None, "admin id": None}
+                                   for uid in range(gid, count, 100)]
+            for gid in range(100)}
+
+
+def get_user_ids(count: int) -> dict:
+    # Get user status records, each with a name, time, one join and a score, and one pass for every tenth user
+    result = {}
+
+    for uid in range(count):
+        record = UserStatus()
+        record["name"] = f"User {uid}"
+        record["time"] = 1580000000 + uid
+        record["join"][-1001000000000 - uid % 1000] = 1580000000 + uid
+        record["score"]["captcha"] = uid % 3 * 0.5
+
+        if uid % 10 == 0:
+            record["pass"][-1001000000000 - uid % 1000] = 1580000000 + uid
+
+        result[uid] = record
+
+    return result
+
+
+def get_words(count: int) -> dict:
+    # Get regex patterns with their hit counts
+    return {f"(?i)word{i}|pattern{i}[a-z]{{2,{i % 9 + 2}}}": i % 5 for i in range(count)}
+
+
+def measure(name: str, data: Any, convert: Callable = None) -> None:
+    # Print the results of both serializers
+    for fast in (False, True):
+        begin = perf_counter()
+        blob = dumps_data(data, fast)
+        dump_time = perf_counter() - begin
+
+        begin = perf_counter()
+        loaded = loads_data(blob)
+        load_time = perf_counter() - begin
+
+        text = f"{name:>12} {'marshal' if fast else 'pickle':>8}: "
+        text += f"dump {dump_time * 1000:.0f} ms, load {load_time * 1000:.0f} ms"
+
+        if convert:
+            begin = perf_counter()
+            {key: convert(value) for key, value in loaded.items()}
+            text += f" + convert {(perf_counter() - begin) * 1000:.0f} ms"
+
+        print(f"{text}, {len(blob) / 1000:.0f} KB")
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    measure("user_ids", get_user_ids(count), UserStatus.from_dict)
+    measure("flood_logs", get_flood_logs(count))
+    measure("words", get_words(count // 5))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of is_class_e_user with the trusted user index, kept by set_trust
+# The old check probed the trust set of every group instead
+# Run from the repository root: python -m bench.trust_index [groups]
+
+import sys
+
+from bench.common import get_time, stub_glovar
+
+glovar = stub_glovar(bot_ids=set(), trust_ids={}, trusted_ids={})
+
+from plugins.functions.filters import is_class_e_user
+from plugins.functions.ids import init_trusted_ids, set_trust
+
+USERS = 5
+
+
+def probe(uid: int) -> bool:
+    # The check of the old is_class_e_user, without the index
+    group_list = list(glovar.trust_ids)
+    return any(uid in glovar.trust_ids.get(gid, set()) for gid in group_list)
+
+
+def main() -> None:
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    # Every group trusts its own users, the first user is trusted by every group
+    for i in range(groups):
+        assert set_trust(-1001000000000 - i, {0} | {i * USERS + j for j in range(1, USERS)})
+
+    # The maintained index must match a rebuild, also after a group is dropped
+    assert set_trust(-1001000000000, None)
+    index = dict(glovar.trusted_ids)
+    assert init_trusted_ids() and glovar.trusted_ids == index and index[0] == groups - 1
+    assert not is_class_e_user(1) and is_class_e_user(0)
+
+    print(f"{groups} groups of {USERS} trusted users")
+
+    for name, uid in (("untrusted", -1), ("last group", groups * USERS - 1)):
+        assert probe(uid) == is_class_e_user(uid)
+        print(f"{name:>10}: before {get_time(probe, uid) * 1000000:.0f} us, "
+              f"after {get_time(is_class_e_user, uid) * 1000000:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Memory and build time of user status records, plain dicts against UserStatus
+# Run from the repository root: python bench/user_status.py [users]
+
+import sys
+from copy import deepcopy
+from os.path import abspath, dirname
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from plugins.records import UserStatus
+
+default_user_status = {
+    "name": "",
+    "mid": 0,
+    "time": 0,
+    "answer": "",
+    "limit": 0,
+    "try": 0,
+    "join": {},
+    "pass": {},
+    "wait": {},
+    "qns": {},
+    "succeeded": {},
+    "failed": {},
+    "restricted": set(),
+    "banned": set(),
+    "manual": set(),
+    "score": {
+        "captcha": 0.0,
+        "clean": 0.0,
+        "lang": 0.0,
+        "long": 0.0,
+        "noflood": 0.0,
+        "noporn": 0.0,
+        "nospam": 0.0,
+        "warn": 0.0
+    }
+}
+
+
+def build(count: int, compact: bool) -> dict:
+    # Build the synthetic users, each with a name, time and one join, and one pass for every tenth user
+    result = {}
+
+    for uid in range(count):
+        record = UserStatus() if compact else deepcopy(default_user_status)
+        record["name"] = f"User {uid}"
+        record["time"] = 1580000000 + uid
+        record["join"][-1001000000000 - uid % 1000] = 1580000000 + uid
+
+        if uid % 10 == 0:
+            record["pass"][-1001000000000 - uid % 1000] = 1580000000 + uid
+
+        result[uid] = record
+
+    return result
+
+
+def measure(count: int, compact: bool) -> None:
+    # Print the traced memory and the build time
+    start()
+    begin = perf_counter()
+    data = build(count, compact)
+    elapsed = perf_counter() - begin
+    size = get_traced_memory()[0]
+    stop()
+
+    name = "UserStatus" if compact else "dict + deepcopy"
+    print(f"{name:>16}: {size // count} bytes/user, {size / 2 ** 20:.0f} MiB, build {elapsed:.1f}s")
+
+    del data
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{count} users")
+    measure(count, False)
+    measure(count, True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cost of the wait index on a join: set_wait, the waiting user list of add_wait, then pop_wait
+# The old add_wait scanned every user record for the list instead
+# Run from the repository root: python -m bench.wait_index
+
+from bench.common import get_time, stub_glovar
+
+glovar = stub_glovar(user_ids={}, wait_ids={}, hint_ids=set(), hint_heap=[])
+
+from plugins.functions.ids import init_wait_ids, pop_wait, set_wait
+from plugins.records import UserStatus
+
+GID = -1001000000000
+NOW = 1580000000
+WAITING = 50
+
+
+def join(uid: int) -> list:
+    # A user joins and waits, the hint lists the waiting users, then the user passes
+    set_wait(uid, GID, NOW)
+    result = list(glovar.wait_ids.get(GID, set()))
+    pop_wait(uid, GID)
+
+    return result
+
+
+def populate(count: int) -> None:
+    # Create the users, WAITING of them wait in the group
+    glovar.user_ids = {}
+    glovar.wait_ids = {}
+
+    for uid in range(count):
+        glovar.user_ids[uid] = UserStatus()
+        glovar.user_ids[uid]["join"][GID - uid % 100] = NOW + uid
+
+        if uid % (count // WAITING) == 0:
+            set_wait(uid, GID, NOW + uid)
+
+
+def scan(uid: int) -> list:
+    # The join of the old add_wait, without the index
+    glovar.user_ids[uid]["wait"][GID] = NOW
+    result = [wid for wid in glovar.user_ids if glovar.user_ids[wid]["wait"].get(GID, 0)]
+    glovar.user_ids[uid]["wait"].pop(GID, 0)
+
+    return result
+
+
+def main() -> None:
+    for count in (1000, 10000, 100000):
+        populate(count)
+        uid = count - 1
+
+        # The maintained index must match a rebuild from the records, before and after the joins
+        index = {gid: set(uids) for gid, uids in glovar.wait_ids.items()}
+        assert sorted(join(uid)) == sorted(scan(uid)) and len(join(uid)) == WAITING + 1
+        assert init_wait_ids() and glovar.wait_ids == index and uid not in glovar.wait_ids[GID]
+
+        print(f"{count:>7} users: scan {get_time(scan, uid) * 1000:.2f} ms, "
+              f"index {get_time(join, uid) * 1000000:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
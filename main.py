@@ -20,21 +20,28 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from asyncio import get_event_loop
 from random import randint
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from pyrogram import Client, idle
 
 from plugins import glovar
-from plugins.functions.etc import delay
-from plugins.functions.timers import (backup_files, interval_hour_01, interval_min_01, interval_min_10,
-                                      new_invite_link, reset_data, send_count, share_failed_users, update_admins,
-                                      update_status)
+from plugins.functions.etc import delay, thread
+from plugins.functions.file import compact_files, save_all, save_loop
+from plugins.functions.ids import init_expiry, init_trusted_ids, init_wait_ids
+from plugins.functions.user import deadline_loop, init_deadlines
+from plugins.functions.timers import (backup_files, delay_loop, expire_ids, instrument_jobs, interval_hour_01,
+                                      interval_min_01, interval_min_10, new_invite_link, reset_data, send_count,
+                                      send_jobs, send_memory, share_failed_users, update_admins, update_status)
 from plugins.session import renew
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Start the writer
+thread(save_loop, (), pool="")
+
 # Renew session
 renew()
 
@@ -45,26 +52,52 @@ app = Client(
 )
 app.start()
 
+# Run the async variants of telegram functions on the event loop of the client
+glovar.coroutine and glovar.pools["coroutine"].start(get_event_loop())
+
 # Send online status
 delay(3, update_status, [app, "online"])
 
 # Reset data
 not glovar.reset_time[1] and reset_data(app)
 
+# Index the expiry time of user records and watch entries
+init_expiry()
+
+# Index the deadlines of waiting, CAPTCHA group and failed users
+init_deadlines()
+
+# Index the waiting users of every group
+init_wait_ids()
+
+# Index the trusted users of every group
+init_trusted_ids()
+
+# Start the deadline checker
+thread(deadline_loop, (app,), pool="")
+
+# Start the delayed action dispatcher
+thread(delay_loop, (app,), pool="")
+
 # Check invite link
 not glovar.invite.get("link") and new_invite_link(app, True)
 
 # Timer
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
 scheduler.add_job(interval_min_01, "interval", [app], minutes=1)
+scheduler.add_job(expire_ids, "interval", minutes=1)
 scheduler.add_job(interval_min_10, "interval", [app], minutes=10)
 scheduler.add_job(interval_hour_01, "interval", hours=1)
+scheduler.add_job(compact_files, "interval", hours=1)
+scheduler.add_job(send_memory, "interval", [app], hours=6)
+scheduler.add_job(send_jobs, "interval", [app], hours=6)
 scheduler.add_job(update_status, "cron", [app, "awake"], minute=randint(30, 34), second=randint(0, 59))
 scheduler.add_job(backup_files, "cron", [app], hour=20)
 scheduler.add_job(send_count, "cron", [app], hour=21)
 scheduler.add_job(share_failed_users, "cron", [app], hour=21, minute=30)
 scheduler.add_job(reset_data, "cron", [app], day=glovar.date_reset, hour=22)
 scheduler.add_job(update_admins, "cron", [app], hour=22, minute=30)
+instrument_jobs(scheduler)
 scheduler.start()
 
 # Hold
@@ -72,3 +105,6 @@ idle()
 
 # Stop
 app.stop()
+
+# Save changed data
+save_all()
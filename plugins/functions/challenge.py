@@ -29,17 +29,19 @@ from pyrogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMa
 
 from .. import glovar
 from .channel import ask_help_welcome, send_debug, share_data
-from .decorators import threaded
+from .decorators import prioritized, threaded
 from .etc import (button_data, code, get_channel_link, get_full_name, get_image_size, get_length, get_now, lang,
                   mention_name, mention_text, random_str, t2t, thread)
 from .file import delete_file, get_new_path, save
 from .filters import (is_declared_message, is_flooded, is_limited_user, is_nm_text, is_should_ignore, is_watch_user,
                       is_wb_text)
 from .group import clear_joined_messages, delete_message, get_hint_text, get_pinned
-from .ids import init_user_id
+from .ids import (add_hint, clear_wait, get_join_rate, init_user_id, lock_message, pop_wait, set_wait,
+                  unlock_message)
 from .markup import get_inline
-from .user import (flood_user, qns_count, restrict_user, terminate_user_punish, terminate_user_succeed,
-                   terminate_user_succeed_qns, terminate_user_wrong, terminate_user_wrong_qns, unrestrict_user)
+from .user import (add_deadline, flood_user, qns_count, restrict_user, terminate_user_punish,
+                   terminate_user_succeed, terminate_user_succeed_qns, terminate_user_wrong, terminate_user_wrong_qns,
+                   unrestrict_user)
 from .telegram import (delete_messages, edit_message_photo, get_chat_member, pin_chat_message,
                        send_message, send_photo, send_report_message)
 
@@ -59,12 +61,13 @@ def add_wait(client: Client, gid: int, user: User, mid: int, aid: int = 0) -> bo
 
         # Add the user to the wait list
         glovar.user_ids[uid]["name"] = name
-        glovar.user_ids[uid]["wait"][gid] = now
+        set_wait(uid, gid, now)
         aid and glovar.user_ids[uid]["manual"].add(gid)
         save("user_ids")
+        add_deadline(uid, now)
 
         # Get group's waiting user list
-        wait_user_list = [wid for wid in glovar.user_ids if glovar.user_ids[wid]["wait"].get(gid, 0)]
+        wait_user_list = list(glovar.wait_ids.get(gid, set()))
 
         # Restrict the user
         restrict_user(client, gid, uid)
@@ -83,7 +86,7 @@ def add_wait(client: Client, gid: int, user: User, mid: int, aid: int = 0) -> bo
         mention_users_text = "".join(mention_text("\U00002060", wid) for wid in mention_user_list)
 
         # Flood situation detected
-        if len(wait_user_list) > glovar.limit_flood:
+        if len(wait_user_list) > glovar.limit_flood or get_join_rate(gid, now) > glovar.limit_join:
             # Delete the joined service message
             not is_flooded(gid) and delete_message(client, gid, mid)
 
@@ -131,54 +134,33 @@ def add_wait(client: Client, gid: int, user: User, mid: int, aid: int = 0) -> bo
         # Generate the hint text
         text += mention_users_text
 
-        # Send the hint message
+        # Send the hint message in the pool, where it can wait for the rate limit outside of the message lock
         if aid == glovar.nospam_id:
-            result = send_hint(
-                client=client,
-                the_type="nospam",
-                gid=gid,
-                user=user
-            )
+            hint = {
+                "the_type": "nospam",
+                "user": user
+            }
         elif aid:
-            result = send_hint(
-                client=client,
-                the_type="manual",
-                gid=gid,
-                mid=mid,
-                user=user
-            )
+            hint = {
+                "the_type": "manual",
+                "mid": mid,
+                "user": user
+            }
         elif len(wait_user_list) == 1:
-            result = send_hint(
-                client=client,
-                the_type="single",
-                gid=gid,
-                mid=mid,
-                user=user
-            )
+            hint = {
+                "the_type": "single",
+                "mid": mid,
+                "user": user
+            }
         else:
-            result = send_hint(
-                client=client,
-                the_type="multi",
-                gid=gid,
-                mid=mid,
-                count=len(wait_user_list),
-                mention=mention_users_text
-            )
-
-        # Check if the message was sent successfully
-        if not result:
-            return add_failed(client, gid, uid, aid)
+            hint = {
+                "the_type": "multi",
+                "mid": mid,
+                "count": len(wait_user_list),
+                "mention": mention_users_text
+            }
 
-        # Send debug message
-        result = send_debug(
-            client=client,
-            gids=[gid],
-            action=lang("action_wait"),
-            uid=uid,
-            aid=aid,
-            em=result,
-            time=now
-        )
+        result = send_wait_hint(client, gid, uid, aid, now, hint)
     except Exception as e:
         logger.warning(f"Add wait error: {e}", exc_info=True)
 
@@ -197,15 +179,16 @@ def add_wait_qns(client: Client, gid: int, user: User, mid: int, aid: int = 0) -
 
         # Add the user to the wait list
         glovar.user_ids[uid]["name"] = name
-        glovar.user_ids[uid]["wait"][gid] = now
+        set_wait(uid, gid, now)
         aid and glovar.user_ids[uid]["manual"].add(gid)
         save("user_ids")
+        add_deadline(uid, now)
 
         # Get group's waiting user list
-        wait_user_list = [wid for wid in glovar.user_ids if glovar.user_ids[wid]["wait"].get(gid, 0)]
+        wait_user_list = list(glovar.wait_ids.get(gid, set()))
 
         # Flood situation detected
-        if len(wait_user_list) > glovar.limit_flood:
+        if len(wait_user_list) > glovar.limit_flood or get_join_rate(gid, now) > glovar.limit_join:
             return add_wait(client, gid, user, mid, aid)
 
         # Restrict the user
@@ -220,50 +203,28 @@ def add_wait_qns(client: Client, gid: int, user: User, mid: int, aid: int = 0) -
         # Mention previous users text
         mention_users_text = "".join(mention_text("\U00002060", wid) for wid in mention_user_list)
 
-        # Send the hint message
+        # Send the hint message in the pool, where it can wait for the rate limit outside of the message lock
         if aid:
-            result = send_hint_qns(
-                client=client,
-                the_type="manual",
-                gid=gid,
-                uid=uid,
-                mid=mid,
-                user=user
-            )
+            hint = {
+                "the_type": "manual",
+                "mid": mid,
+                "user": user
+            }
         elif len(wait_user_list) == 1:
-            result = send_hint_qns(
-                client=client,
-                the_type="single",
-                gid=gid,
-                uid=uid,
-                mid=mid,
-                user=user
-            )
+            hint = {
+                "the_type": "single",
+                "mid": mid,
+                "user": user
+            }
         else:
-            result = send_hint_qns(
-                client=client,
-                the_type="multi",
-                gid=gid,
-                uid=uid,
-                mid=mid,
-                count=len(wait_user_list),
-                mention=mention_users_text
-            )
-
-        # Check if the message was sent successfully
-        if not result:
-            return add_failed(client, gid, uid, aid)
+            hint = {
+                "the_type": "multi",
+                "mid": mid,
+                "count": len(wait_user_list),
+                "mention": mention_users_text
+            }
 
-        # Send debug message
-        result = send_debug(
-            client=client,
-            gids=[gid],
-            action=lang("action_wait"),
-            uid=uid,
-            aid=aid,
-            em=result,
-            time=now
-        )
+        result = send_wait_hint(client, gid, uid, aid, now, hint, True)
     except Exception as e:
         logger.warning(f"Add wait qns error: {e}", exc_info=True)
 
@@ -276,7 +237,7 @@ def add_failed(client: Client, gid: int, uid: int, aid: int) -> bool:
 
     try:
         unrestrict_user(client, gid, uid)
-        glovar.user_ids[uid]["wait"].pop(gid, 0)
+        pop_wait(uid, gid)
         glovar.user_ids[uid]["qns"].pop(gid, "")
         aid and glovar.user_ids[uid]["manual"].discard(gid)
         save("user_ids")
@@ -755,6 +716,7 @@ def get_return_link(uid: int) -> str:
     return result
 
 
+@prioritized("captcha")
 def question_answer(client: Client, uid: int, text: str) -> bool:
     # Answer the question
     result = False
@@ -795,6 +757,7 @@ def question_answer(client: Client, uid: int, text: str) -> bool:
     return result
 
 
+@prioritized("captcha")
 def question_answer_qns(client: Client, callback_query: CallbackQuery) -> bool:
     # Answer the qns question
     result = False
@@ -861,8 +824,10 @@ def question_answer_qns(client: Client, callback_query: CallbackQuery) -> bool:
     return result
 
 
+@prioritized("captcha")
+@threaded()
 def question_ask(client: Client, user: User, mid: int) -> bool:
-    # Ask a new question
+    # Ask a new question, the message is sent outside of the message lock and the result is saved under it
     result = False
 
     try:
@@ -906,7 +871,7 @@ def question_ask(client: Client, user: User, mid: int) -> bool:
                 mid=mid,
                 markup=markup
             )
-            image_path.startswith("tmp/") and thread(delete_file, (image_path,))
+            image_path.startswith("tmp/") and thread(delete_file, (image_path,), pool="file")
         else:
             result = send_message(
                 client=client,
@@ -916,23 +881,29 @@ def question_ask(client: Client, user: User, mid: int) -> bool:
                 markup=markup
             )
 
-        # Check if the message was sent successfully
-        if result:
-            captcha_message_id = result.message_id
-            glovar.user_ids[uid]["type"] = question_type
-            glovar.user_ids[uid]["mid"] = captcha_message_id
-            glovar.user_ids[uid]["time"] = now
-            glovar.user_ids[uid]["answer"] = captcha["answer"]
-            glovar.user_ids[uid]["limit"] = limit
-        else:
-            wait_group_list = list(glovar.user_ids[uid]["wait"])
+        held = lock_message(uids=[uid], waiting=True)
 
-            for gid in wait_group_list:
-                unrestrict_user(client, gid, uid)
+        try:
+            # Check if the message was sent successfully
+            if result:
+                captcha_message_id = result.message_id
+                glovar.user_ids[uid]["type"] = question_type
+                glovar.user_ids[uid]["mid"] = captcha_message_id
+                glovar.user_ids[uid]["time"] = now
+                glovar.user_ids[uid]["answer"] = captcha["answer"]
+                glovar.user_ids[uid]["limit"] = limit
+            else:
+                wait_group_list = list(glovar.user_ids[uid]["wait"])
 
-            glovar.user_ids[uid]["wait"] = {}
+                for gid in wait_group_list:
+                    unrestrict_user(client, gid, uid)
 
-        save("user_ids")
+                clear_wait(uid)
+
+            save("user_ids")
+            add_deadline(uid, now)
+        finally:
+            unlock_message(held)
 
         result = True
     except Exception as e:
@@ -995,7 +966,7 @@ def question_change(client: Client, uid: int, mid: int) -> bool:
             caption=text,
             markup=markup
         )
-        image_path.startswith("tmp/") and thread(delete_file, (image_path,))
+        image_path.startswith("tmp/") and thread(delete_file, (image_path,), pool="file")
 
         # Check if the message was edited successfully
         if not result:
@@ -1014,6 +985,7 @@ def question_change(client: Client, uid: int, mid: int) -> bool:
     return result
 
 
+@prioritized("captcha")
 @threaded()
 def question_status(client: Client, uid: int, the_type: str, link: str = "") -> bool:
     # Reply question status
@@ -1117,9 +1089,11 @@ def send_hint(client: Client, the_type: str, gid: int,
         if the_type == "manual":
             new_id = result.message_id
             glovar.message_ids[gid]["manual"][new_id] = get_now()
+            add_hint(gid, get_now() + glovar.time_captcha)
         elif the_type == "nospam":
             new_id = result.message_id
             glovar.message_ids[gid]["nospam"][new_id] = get_now()
+            add_hint(gid, get_now() + glovar.time_captcha)
         else:
             new_id = result.message_id
             old_id = glovar.message_ids[gid]["hint"]
@@ -1221,6 +1195,7 @@ def send_hint_qns(client: Client, the_type: str, gid: int,
         if the_type == "manual":
             new_id = result.message_id
             glovar.message_ids[gid]["manual"][new_id] = get_now()
+            add_hint(gid, get_now() + glovar.time_captcha)
         else:
             new_id = result.message_id
             old_id = glovar.message_ids[gid]["hint"]
@@ -1320,6 +1295,48 @@ def send_static(client: Client, gid: int, text: str, flood: bool = False, temp:
     return result
 
 
+@threaded()
+def send_wait_hint(client: Client, gid: int, uid: int, aid: int, now: int, hint: dict, qns: bool = False) -> bool:
+    # Send the hint for a new waiting user, then check the result under the message lock
+    result = False
+
+    try:
+        if qns:
+            result = send_hint_qns(client=client, gid=gid, uid=uid, **hint)
+        else:
+            result = send_hint(client=client, gid=gid, **hint)
+
+        held = lock_message([gid], [uid])
+
+        try:
+            # The user left the wait list while the hint was sent
+            if not glovar.user_ids[uid]["wait"].get(gid, 0):
+                glovar.user_ids[uid]["qns"].pop(gid, "")
+                save("user_ids")
+                return False
+
+            # Check if the message was sent successfully
+            if not result:
+                return add_failed(client, gid, uid, aid)
+        finally:
+            unlock_message(held)
+
+        # Send debug message
+        result = send_debug(
+            client=client,
+            gids=[gid],
+            action=lang("action_wait"),
+            uid=uid,
+            aid=aid,
+            em=result,
+            time=now
+        )
+    except Exception as e:
+        logger.warning(f"Send wait hint error: {e}", exc_info=True)
+
+    return result
+
+
 def user_captcha(client: Client, message: Optional[Message], gid: int, user: User, mid: int, now: int,
                  aid: int = 0) -> bool:
     # User CAPTCHA
@@ -24,7 +24,7 @@ from pyrogram import Client
 from pyrogram.types import Chat, Message
 
 from .. import glovar
-from .decorators import threaded
+from .decorators import prioritized, threaded
 from .etc import code, code_block, general_link, get_channel_link, get_readable_time, lang, message_link, thread
 from .file import crypt_file, data_to_file, delete_file, get_new_path, save
 from .filters import is_class_d_user
@@ -133,7 +133,7 @@ def exchange_to_hide(client: Client) -> bool:
         text = (f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n"
                 f"{lang('issue')}{lang('colon')}{code(lang('exchange_invalid'))}\n"
                 f"{lang('auto_fix')}{lang('colon')}{code(lang('protocol_1'))}\n")
-        thread(send_message, (client, glovar.critical_channel_id, text))
+        thread(send_message, (client, glovar.critical_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -197,7 +197,8 @@ def get_debug_text(client: Client, context: Union[int, Chat, List[int]]) -> str:
     return result
 
 
-@threaded()
+@prioritized("debug")
+@threaded(pool="debug")
 def send_debug(client: Client, gids: List[int], action: str,
                uid: int = 0, aid: int = 0,
                em: Union[int, Message] = 0, time: int = 0, duration: int = 0,
@@ -244,7 +245,7 @@ def send_debug(client: Client, gids: List[int], action: str,
 
         if file:
             result = bool(send_document(client, glovar.debug_channel_id, file, text))
-            thread(delete_file, (file,))
+            thread(delete_file, (file,), pool="file")
         else:
             result = bool(send_message(client, glovar.debug_channel_id, text))
     except Exception as e:
@@ -253,6 +254,7 @@ def send_debug(client: Client, gids: List[int], action: str,
     return result
 
 
+@prioritized("share")
 @threaded()
 def share_data(client: Client, receivers: List[str], action: str, action_type: str,
                data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
@@ -309,7 +311,7 @@ def share_data(client: Client, receivers: List[str], action: str, action_type: s
 
         # Delete the tmp file
         for f in {file, file_path}:
-            f.startswith("tmp/") and thread(delete_file, (f,))
+            f.startswith("tmp/") and thread(delete_file, (f,), pool="file")
 
         result = bool(result)
     except Exception as e:
@@ -318,6 +320,7 @@ def share_data(client: Client, receivers: List[str], action: str, action_type: s
     return result
 
 
+@prioritized("share")
 @threaded()
 def share_data_failed(client: Client, receivers: List[str], action: str, action_type: str,
                       data: Union[bool, dict, int, str] = None, file: str = None, encrypt: bool = True) -> bool:
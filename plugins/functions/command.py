@@ -21,7 +21,7 @@ import logging
 from pyrogram import Client
 from pyrogram.types import Message
 
-from .etc import code, delay, get_text, lang, thread
+from .etc import add_delay, code, get_text, lang, thread
 from .filters import is_class_c
 from .group import delete_message
 from .telegram import send_message, send_report_message
@@ -58,7 +58,7 @@ def delete_shared_command(client: Client, message: Message) -> bool:
 
         # Delete the command
         if is_class_c(None, None, message):
-            delay(5, delete_message, [client, gid, mid])
+            add_delay(5, "delete_message", [gid, mid])
         else:
             delete_message(client, gid, mid)
 
@@ -345,7 +345,7 @@ def qns_show_file(client: Client, message: Message, gid: int,
         send_document(client, cid, file, caption, mid)
 
         # Delete the file
-        thread(delete_file, (file,))
+        thread(delete_file, (file,), pool="file")
 
         result = True
     except Exception as e:
@@ -18,14 +18,43 @@
 
 import logging
 from functools import wraps
+from inspect import iscoroutine
+from threading import local
 
 from pyrogram.errors import FloodWait
 
-from .etc import thread, wait_flood
+from .etc import run_priority, thread, wait_flood
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Whether the current thread runs the async variant of a telegram function
+variant = local()
+
+
+def awaitable(func):
+    # Attach the async variant of a telegram function, thread runs it on the event loop in coroutine mode
+    # The variant runs the same body on the loop, its requests return coroutines of the native client methods
+    async def coroutine(level: str, args: tuple, kwargs: dict = None):
+        variant.asynchronous = True
+        try:
+            result = run_priority(level, func, args, kwargs)
+        finally:
+            variant.asynchronous = False
+        return await result if iscoroutine(result) else result
+    func.coroutine = coroutine
+    return func
+
+
+def prioritized(level: str):
+    # Make the API calls of the function in the priority class
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return run_priority(level, func, args, kwargs)
+        return wrapper
+    return decorator
+
 
 def retry(func):
     # FloodWait retry
@@ -46,11 +75,12 @@ def retry(func):
     return wrapper
 
 
-def threaded(daemon: bool = True):
-    # Run with thread
+def threaded(daemon: bool = True, pool: str = "telegram"):
+    # Run with thread, the function stays callable in the current thread as sync
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            return thread(func, args, kwargs, daemon)
+            return thread(func, args, kwargs, daemon, pool)
+        wrapper.sync = func
         return wrapper
     return decorator
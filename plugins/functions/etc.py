@@ -17,16 +17,22 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from array import array
+from asyncio import sleep as async_sleep
+from collections import deque
 from copy import deepcopy
 from datetime import datetime
+from heapq import heappush
 from html import escape
 from json import dumps
 from random import choice, uniform
 from re import sub
 from string import ascii_letters, digits
+from sys import getsizeof
 from threading import Thread, Timer
 from time import localtime, sleep, strftime, time
-from typing import Any, Callable, Optional, Union
+from types import FunctionType, ModuleType
+from typing import Any, Callable, Dict, Optional, Union
 from unicodedata import normalize
 
 from cryptography.fernet import Fernet
@@ -36,6 +42,7 @@ from pyrogram.types import Message, User
 from pyrogram.errors import FloodWait
 
 from .. import glovar
+from ..rates import priority
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -44,6 +51,34 @@ logger = logging.getLogger(__name__)
 converter = OpenCC(config="t2s.json")
 
 
+def add_delay(secs: int, action: str, args: list) -> str:
+    # Add an action to the delayed action queue, the client is given by the dispatcher, return the action id
+    result = ""
+
+    try:
+        the_id = random_str(8)
+
+        with glovar.delay_condition:
+            while the_id in glovar.delays:
+                the_id = random_str(8)
+
+            due = time() + secs
+            glovar.delays[the_id] = {
+                "time": due,
+                "action": action,
+                "args": list(args)
+            }
+            heappush(glovar.delay_heap, (due, the_id))
+            glovar.delay_stats["added"] += 1
+            glovar.delay_condition.notify()
+
+        result = the_id
+    except Exception as e:
+        logger.warning(f"Add delay error: {e}", exc_info=True)
+
+    return result
+
+
 def bold(text: Any) -> str:
     # Get a bold text
     result = ""
@@ -189,6 +224,52 @@ def get_channel_link(message: Union[int, Message]) -> str:
     return result
 
 
+def get_deep_size(obj: Any) -> int:
+    # Get the size of an object and everything it holds, in bytes
+    result = 0
+
+    try:
+        seen = set()
+        objects = [obj]
+
+        while objects:
+            the_obj = objects.pop()
+
+            if id(the_obj) in seen or isinstance(the_obj, (type, ModuleType, FunctionType)):
+                continue
+
+            seen.add(id(the_obj))
+            result += getsizeof(the_obj)
+
+            if isinstance(the_obj, dict):
+                for key, value in list(the_obj.items()):
+                    objects.append(key)
+                    objects.append(value)
+            elif isinstance(the_obj, (list, tuple, set, frozenset, deque)):
+                objects.extend(list(the_obj))
+            elif isinstance(the_obj, (str, bytes, int, float, array)):
+                continue
+
+            # Walk the attributes, skip private ones such as the client of a pyrogram object
+            for cls in type(the_obj).__mro__:
+                objects.extend(getattr(the_obj, slot) for slot in getattr(cls, "__slots__", ())
+                               if isinstance(slot, str) and not slot.startswith("_") and hasattr(the_obj, slot))
+
+            if hasattr(the_obj, "__dict__"):
+                objects.extend(value for key, value in list(vars(the_obj).items()) if not key.startswith("_"))
+    except Exception as e:
+        logger.warning(f"Get deep size error: {e}", exc_info=True)
+
+    return result
+
+
+def get_flood_wait(e: FloodWait) -> float:
+    # Record the FloodWait that the limiter did not prevent, get the seconds to wait
+    glovar.limiter.record_flood(e.x)
+
+    return e.x + uniform(0.5, 1.0)
+
+
 def get_full_name(user: User, normal: bool = False, printable: bool = False, pure: bool = False) -> str:
     # Get user's full name
     result = ""
@@ -239,6 +320,42 @@ def get_int(text: str) -> Optional[int]:
     return result
 
 
+def get_job_text(limit: int = 15) -> str:
+    # Get the scheduled job report text, times in seconds
+    result = ""
+
+    try:
+        now = get_now()
+        buckets = " / ".join(f"<{bucket}s" for bucket in glovar.job_buckets) + f" / >{glovar.job_buckets[-1]}s"
+        result = (f"{lang('memory_format')}{lang('colon')}{code(lang('job_columns'))}\n"
+                  f"{lang('job_histogram')}{lang('colon')}{code(buckets)}\n")
+
+        for name in sorted(glovar.job_stats, key=lambda n: glovar.job_stats[n]["total"], reverse=True)[:limit]:
+            stats = glovar.job_stats[name]
+            average = round(stats["total"] / stats["runs"], 2) if stats["runs"] else 0.0
+            since = stats["last"] and now - stats["last"]
+            histogram = ",".join(str(count) for count in stats["buckets"])
+            text = (f"{stats['runs']} / {stats['failed']} / {stats['missed']} / {stats['skipped']} / "
+                    f"{average} / {round(stats['max'], 2)} / {round(stats['lock'], 2)} / {since} / {histogram}")
+            result += f"{code(name)}{lang('colon')}{code(text)}\n"
+
+        waits = [name for name in glovar.locks if getattr(glovar.locks[name], "count", 0)]
+
+        if not waits:
+            return result
+
+        result += f"{lang('lock_wait')}{lang('colon')}{code(lang('lock_columns'))}\n"
+
+        for name in sorted(waits, key=lambda n: glovar.locks[n].time, reverse=True):
+            lock = glovar.locks[name]
+            text = f"{lock.count} / {round(lock.time, 2)} / {round(lock.max, 2)}"
+            result += f"{code(name)}{lang('colon')}{code(text)}\n"
+    except Exception as e:
+        logger.warning(f"Get job text error: {e}", exc_info=True)
+
+    return result
+
+
 def get_length(text: str) -> int:
     # Get the length of the string
     result = 0
@@ -275,6 +392,59 @@ def get_length(text: str) -> int:
     return result
 
 
+def get_memory_status(sample: bool = False) -> Dict[str, Dict[str, int]]:
+    # Get the deep size, entry count and growth of the global variables, sorted by size
+    result = {}
+
+    try:
+        names = glovar.file_list + ["changed_ids", "chats", "chinese_words", "declared_message_ids", "expiry_heap",
+                                    "journal_digests", "pics", "usernames", "wait_ids"]
+
+        for name in names:
+            # Do not load a lazy variable just to measure it
+            if name in glovar.lazy_defaults and name not in vars(glovar):
+                continue
+
+            data = eval(f"glovar.{name}")
+            size = get_deep_size(data)
+            result[name] = {
+                "size": size,
+                "count": len(data) if hasattr(data, "__len__") else 0,
+                "growth": size - glovar.memory_sizes.get(name, size)
+            }
+
+        result = dict(sorted(result.items(), key=lambda x: x[1]["size"], reverse=True))
+
+        if sample:
+            glovar.memory_sizes = {name: result[name]["size"] for name in result}
+    except Exception as e:
+        logger.warning(f"Get memory status error: {e}", exc_info=True)
+
+    return result
+
+
+def get_memory_text(memory_status: Dict[str, Dict[str, int]], limit: int = 10) -> str:
+    # Get the memory report text, sizes in KB
+    result = ""
+
+    try:
+        total = sum(memory_status[name]["size"] for name in memory_status)
+        growth = sum(memory_status[name]["growth"] for name in memory_status)
+        total_text = f"{round(total / 1024)} KB ({round(growth / 1024):+} KB)"
+        result = (f"{lang('memory_total')}{lang('colon')}{code(total_text)}\n"
+                  f"{lang('memory_format')}{lang('colon')}{code(lang('memory_columns'))}\n")
+
+        for name in list(memory_status)[:limit]:
+            size = round(memory_status[name]["size"] / 1024)
+            count = memory_status[name]["count"]
+            growth = round(memory_status[name]["growth"] / 1024)
+            result += f"{code(name)}{lang('colon')}{code(f'{size} KB / {count} / {growth:+} KB')}\n"
+    except Exception as e:
+        logger.warning(f"Get memory text error: {e}", exc_info=True)
+
+    return result
+
+
 def get_now() -> int:
     # Get time for now
     result = 0
@@ -287,6 +457,55 @@ def get_now() -> int:
     return result
 
 
+def get_pool_text() -> str:
+    # Get the thread pool report text
+    result = ""
+
+    try:
+        result = f"{lang('memory_format')}{lang('colon')}{code(lang('pool_columns'))}\n"
+
+        for name in sorted(glovar.pools):
+            status = glovar.pools[name].get_status()
+            text = " / ".join(str(status[key]) for key in ["workers", "active", "queued", "peak",
+                                                           "completed", "overflow", "rejected"])
+            result += f"{code(name)}{lang('colon')}{code(text)}\n"
+    except Exception as e:
+        logger.warning(f"Get pool text error: {e}", exc_info=True)
+
+    return result
+
+
+def get_priority() -> str:
+    # Get the priority class of the API calls made by the current thread
+    result = glovar.priorities[1]
+
+    try:
+        result = getattr(priority, "level", result)
+    except Exception as e:
+        logger.warning(f"Get priority error: {e}", exc_info=True)
+
+    return result
+
+
+def get_rate_wait(count: int, cid: int, limit: float, level: str, held: bool = False) -> Optional[float]:
+    # Reserve the API budgets for a call of the priority class, return the seconds to wait, None if the call is shed,
+    # or the negative seconds to wait before trying again if the class is deferred
+    hold = glovar.priority_holds[level]
+
+    # A dropped class sheds its calls above the hold
+    if level in glovar.priority_drops and hold >= 0:
+        limit = hold if limit < 0 else min(limit, hold)
+
+    # A thread holding the message lock or a stripe never sleeps, the other handlers and the timers would wait too
+    # It sheds a call of a dropped class that would wait, other classes take the budget in advance instead,
+    # the owed tokens delay the next calls made outside of the locks
+    if held:
+        limit = 0 if level in glovar.priority_drops else limit
+        hold = -1
+
+    return glovar.limiter.reserve(time(), count, cid, limit, hold, level)
+
+
 def get_readable_time(secs: int = 0, the_format: str = "%Y%m%d%H%M%S") -> str:
     # Get a readable time string
     result = ""
@@ -354,6 +573,19 @@ def get_text_user(text: str, user: User) -> str:
     return result
 
 
+def is_locked() -> bool:
+    # Check if the current thread holds the message lock or a group or user stripe
+    result = False
+
+    try:
+        result = (glovar.locks["message"].is_held()
+                  or bool(glovar.group_locks.get_held()) or bool(glovar.user_locks.get_held()))
+    except Exception as e:
+        logger.warning(f"Is locked error: {e}", exc_info=True)
+
+    return result
+
+
 def lang(text: str) -> str:
     # Get the text
     result = ""
@@ -429,6 +661,53 @@ def random_str(i: int) -> str:
     return result
 
 
+def run_priority(level: str, target: Callable, args: tuple, kwargs: dict = None) -> Any:
+    # Call a function, its API calls are in the priority class
+    old = get_priority()
+    priority.level = level
+
+    try:
+        return target(*args, **(kwargs or {}))
+    finally:
+        priority.level = old
+
+
+async def sleep_flood(e: FloodWait) -> bool:
+    # Wait flood secs without blocking the event loop
+    result = False
+
+    try:
+        await async_sleep(get_flood_wait(e))
+        result = True
+    except Exception as e:
+        logger.warning(f"Sleep flood error: {e}", exc_info=True)
+
+    return result
+
+
+async def sleep_rate(level: str, count: int = 1, cid: int = 0, limit: float = -1) -> bool:
+    # Wait for the API budgets of the bot and of the chat without blocking the event loop, like wait_rate
+    result = True
+
+    try:
+        while True:
+            wait = get_rate_wait(count, cid, limit, level)
+
+            if wait is None:
+                return False
+
+            if wait >= 0:
+                break
+
+            await async_sleep(-wait)
+
+        count and wait and await async_sleep(wait)
+    except Exception as e:
+        logger.warning(f"Sleep rate error: {e}", exc_info=True)
+
+    return result
+
+
 def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
     # Convert the string, text to text
     result = text
@@ -457,11 +736,26 @@ def t2t(text: str, normal: bool, printable: bool, pure: bool = False) -> str:
     return result
 
 
-def thread(target: Callable, args: tuple, kwargs: dict = None, daemon: bool = True) -> bool:
-    # Call a function using thread
+def thread(target: Callable, args: tuple, kwargs: dict = None, daemon: bool = True, pool: str = "telegram") -> bool:
+    # Call a function in the pool, or in a new thread if the pool is empty or the thread is not a daemon
     result = False
 
     try:
+        # The task keeps the priority class of the caller
+        level = "debug" if pool == "debug" else get_priority()
+
+        # Run the async variant on the event loop, a full or stopped loop leaves the call to the pool
+
+        if (pool == "telegram" and glovar.coroutine and hasattr(target, "coroutine")
+                and glovar.pools["coroutine"].submit(target.coroutine, (level, args, kwargs))):
+            return True
+
+        # The pool workers are daemon threads, a thread holding a lock never waits for a full pool
+        if pool and daemon:
+            return glovar.pools[pool].submit(run_priority, (level, target, args, kwargs), None,
+                                             glovar.priorities.index(level), not is_locked(),
+                                             level in glovar.priority_drops)
+
         t = Thread(target=target, args=args, kwargs=kwargs, daemon=daemon)
         t.daemon = daemon
         result = t.start() or True
@@ -476,8 +770,36 @@ def wait_flood(e: FloodWait) -> bool:
     result = False
 
     try:
-        result = sleep(e.x + uniform(0.5, 1.0)) or True
+        result = sleep(get_flood_wait(e)) or True
     except Exception as e:
         logger.warning(f"Wait flood error: {e}", exc_info=True)
 
     return result
+
+
+def wait_rate(count: int = 1, cid: int = 0, limit: float = -1) -> bool:
+    # Wait for the API budgets of the bot and of the chat, return False without waiting if the call is shed
+    # An error in the limiter never blocks a call
+    result = True
+
+    try:
+        level = get_priority()
+        held = is_locked()
+
+        while True:
+            wait = get_rate_wait(count, cid, limit, level, held)
+
+            if wait is None:
+                return False
+
+            if wait >= 0:
+                break
+
+            # Deferred, give the budget to higher classes until the backlog drains to the hold
+            sleep(-wait)
+
+        count and wait and not held and sleep(wait)
+    except Exception as e:
+        logger.warning(f"Wait rate error: {e}", exc_info=True)
+
+    return result
@@ -18,18 +18,18 @@
 
 import logging
 from csv import writer
-from os import remove
-from os.path import exists
-from pickle import dump
-from shutil import copyfile
-from time import sleep
-from typing import Any, List
+from hashlib import blake2b
+from os import fsync, remove, replace
+from os.path import exists, getsize
+from pickle import HIGHEST_PROTOCOL, dump, dumps
+from time import sleep, time
+from typing import Any, Dict, List
 
 from pyAesCrypt import decryptFile, encryptFile
 from pyrogram import Client
 
 from .. import glovar
-from .decorators import threaded
+from ..storage import UserStore, append_journal, dumps_data, get_digest, get_shard_paths, write_atomic, write_data
 from .etc import random_str
 from .telegram import download_media
 
@@ -37,6 +37,21 @@ from .telegram import download_media
 logger = logging.getLogger(__name__)
 
 
+def compact_files() -> bool:
+    # Write fresh snapshots of the journaled global variables
+    result = False
+
+    try:
+        for file in list(glovar.journal_digests):
+            exists(f"data/{file}.journal") and save_file(file, True)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Compact files error: {e}", exc_info=True)
+
+    return result
+
+
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
     result = False
@@ -143,6 +158,27 @@ def get_downloaded_path(client: Client, file_id: str) -> str:
     return result
 
 
+def get_file_hash(path: str) -> str:
+    # Get the content hash of a file
+    result = ""
+
+    try:
+        if not exists(path):
+            return ""
+
+        file_hash = blake2b(digest_size=16)
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                file_hash.update(chunk)
+
+        result = file_hash.hexdigest()
+    except Exception as e:
+        logger.warning(f"Get file hash error: {e}", exc_info=True)
+
+    return result
+
+
 def get_new_path(extension: str = "", prefix: str = "") -> str:
     # Get a new path in tmp directory
     result = ""
@@ -160,23 +196,301 @@ def get_new_path(extension: str = "", prefix: str = "") -> str:
     return result
 
 
-@threaded(daemon=False)
+def get_save_status() -> Dict[str, float]:
+    # Get the status of the writer
+    result = {}
+
+    try:
+        requested = glovar.save_stats["requested"]
+        flushed = glovar.save_stats["flushed"]
+        latency = glovar.save_stats["latency"]
+
+        result = {
+            "requested": requested,
+            "flushed": flushed,
+            "pending": len(glovar.dirty_files),
+            "journal": glovar.save_stats["journal"],
+            "shards": glovar.save_stats["shards"],
+            "ratio": round(requested / flushed, 2) if flushed else 0.0,
+            "latency": round(latency / flushed, 3) if flushed else 0.0,
+            "max": round(glovar.save_stats["max"], 3),
+            "time": round(glovar.save_stats["time"] / flushed, 3) if flushed else 0.0
+        }
+    except Exception as e:
+        logger.warning(f"Get save status error: {e}", exc_info=True)
+
+    return result
+
+
 def save(file: str) -> bool:
+    # Mark a global variable as changed, the writer will save it to a file later
+    result = False
+
+    try:
+        glovar.save_stats["requested"] += 1
+        glovar.dirty_files.setdefault(file, time())
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save error: {e}", exc_info=True)
+
+    return result
+
+
+def save_all() -> bool:
+    # Save all changed global variables immediately
+    result = False
+
+    try:
+        for file in list(glovar.dirty_files):
+            save_file(file)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Save all error: {e}", exc_info=True)
+
+    return result
+
+
+def save_file(file: str, compact: bool = False) -> bool:
     # Save a global variable to a file
     result = False
 
+    glovar.locks["save"].acquire()
+
     try:
-        if not glovar:
-            return False
+        marked = glovar.dirty_files.pop(file, None)
+
+        if marked is None and not compact:
+            return True
+
+        start = time()
+        data = eval(f"glovar.{file}")
+
+        if isinstance(data, UserStore):
+            data.commit()
+        elif file == "user_ids" and glovar.limit_shard > 1:
+            save_shards(file, data)
+        elif glovar.journal and isinstance(data, dict) and not compact and file in glovar.journal_digests:
+            save_journal(file, data)
+        else:
+            save_snapshot(file, data)
 
+        if marked is None:
+            return True
+
+        end = time()
+        glovar.save_stats["flushed"] += 1
+        glovar.save_stats["latency"] += end - marked
+        glovar.save_stats["max"] = max(glovar.save_stats["max"], end - marked)
+        glovar.save_stats["time"] += end - start
+        glovar.save_stats["last"][file] = end
+
+        result = True
+    except RuntimeError:
+        marked is not None and glovar.dirty_files.setdefault(file, marked)
+    except Exception as e:
+        logger.warning(f"Save file error: {e}", exc_info=True)
+    finally:
+        glovar.locks["save"].release()
+
+    return result
+
+
+def save_journal(file: str, data: dict) -> bool:
+    # Append the changed keys of a global variable to its journal
+    result = False
+
+    try:
+        digests = glovar.journal_digests[file]
+        new_digests = {}
+        keys = list(data)
+        records = []
+
+        for key in keys:
+            if key not in data:
+                continue
+
+            value = data[key]
+
+            # Records with a dirty flag are only serialized after a change
+            if key in digests and not getattr(value, "dirty_", True):
+                continue
+
+            hasattr(value, "dirty_") and setattr(value, "dirty_", False)
+            blob = dumps(value, HIGHEST_PROTOCOL)
+            digest = get_digest(blob)
+
+            if digests.get(key) == digest:
+                continue
+
+            records.append(("set", key, blob))
+            new_digests[key] = digest
+
+        deleted = digests.keys() - set(keys)
+        records += [("del", key, b"") for key in deleted]
+
+        if not records:
+            return True
+
+        # A new journal records the snapshot it follows
+        if not exists(f"data/{file}.journal"):
+            records.insert(0, ("base", None, bytes.fromhex(get_file_hash(f"data/{file}"))))
+
+        try:
+            append_journal(f"data/{file}.journal", records)
+        except Exception:
+            for key in new_digests:
+                hasattr(data.get(key), "dirty_") and setattr(data[key], "dirty_", True)
+
+            raise
+
+        digests.update(new_digests)
+
+        for key in deleted:
+            digests.pop(key, None)
+
+        glovar.save_stats["journal"] += len(records)
+
+        # Compact the journal when it grows larger than the snapshot
+        if getsize(f"data/{file}.journal") > max(getsize(f"data/{file}"), 1024 * 1024):
+            save_snapshot(file, data)
+
+        result = True
+    except RuntimeError:
+        raise
+    except Exception as e:
+        logger.warning(f"Save journal error: {e}", exc_info=True)
+
+    return result
+
+
+def save_loop() -> None:
+    # Write changed global variables to files, each file at most once per time_save seconds
+    while True:
+        try:
+            now = time()
+
+            for file in list(glovar.dirty_files):
+                if now - glovar.save_stats["last"].get(file, 0) < glovar.time_save:
+                    continue
+
+                save_file(file)
+        except Exception as e:
+            logger.warning(f"Save loop error: {e}", exc_info=True)
+        finally:
+            sleep(1)
+
+
+def save_shards(file: str, data: dict) -> bool:
+    # Write the changed shards of a global variable, a shard holds the keys with the same remainder
+    result = False
+
+    try:
+        count = glovar.limit_shard
+        shards = [{} for _ in range(count)]
+        dirty = set()
+
+        for key in list(data):
+            record = data.get(key)
+
+            if record is None:
+                continue
+
+            index = key % count
+            shards[index][key] = record
+
+            # Records without a dirty flag are always written
+            getattr(record, "dirty_", True) and dirty.add(index)
+
+        sizes = glovar.shard_sizes.setdefault(file, {})
+        written = 0
+
+        for index, shard in enumerate(shards):
+            if index not in dirty and sizes.get(index) == len(shard) and exists(f"data/{file}.{index}"):
+                continue
+
+            for record in shard.values():
+                hasattr(record, "dirty_") and setattr(record, "dirty_", False)
+
+            try:
+                with open(f"data/.{file}.{index}", "wb") as f:
+                    write_data(shard, f, glovar.marshal)
+                    f.flush()
+                    fsync(f.fileno())
+            except Exception:
+                for record in shard.values():
+                    hasattr(record, "dirty_") and setattr(record, "dirty_", True)
+
+                raise
+
+            replace(f"data/.{file}.{index}", f"data/{file}.{index}")
+            sizes[index] = len(shard)
+            written += 1
+
+        # Remove the shards of another shard count
+        for index, path in get_shard_paths(file).items():
+            if index < count:
+                continue
+
+            remove(path)
+            sizes.pop(index, None)
+
+        glovar.save_stats["shards"] += written
+
+        result = True
+    except RuntimeError:
+        raise
+    except Exception as e:
+        logger.warning(f"Save shards error: {e}", exc_info=True)
+
+    return result
+
+
+def save_snapshot(file: str, data: Any) -> bool:
+    # Write the whole global variable to its file, then remove its journal
+    result = False
+
+    records = [value for value in list(data.values()) if hasattr(value, "dirty_")] if isinstance(data, dict) else []
+
+    try:
+        # The snapshot holds every change made before this point
+        for record in records:
+            record.dirty_ = False
+
+        if glovar.journal and isinstance(data, dict):
+            blobs = {key: dumps(data[key], HIGHEST_PROTOCOL) for key in list(data) if key in data}
+            digests = {key: get_digest(blobs[key]) for key in blobs}
+        else:
+            digests = None
+
+        blob = dumps_data(data, glovar.marshal)
+
+        # Keep the backup copy, then publish the snapshot atomically
         with open(f"data/.{file}", "wb") as f:
-            dump(eval(f"glovar.{file}"), f)
+            f.write(blob)
 
-        result = copyfile(f"data/.{file}", f"data/{file}") or True
+        write_atomic(f"data/{file}", blob)
+
+        # A journal left here by a crash starts with the digest of the old snapshot, it will be skipped
+        if exists(f"data/{file}.journal"):
+            remove(f"data/{file}.journal")
+
+        if digests is not None:
+            glovar.journal_digests[file] = digests
+        else:
+            glovar.journal_digests.pop(file, None)
+
+        result = True
     except RuntimeError:
-        sleep(1)
-        return save(file)
+        for record in records:
+            record.dirty_ = True
+
+        raise
     except Exception as e:
-        logger.warning(f"Save error: {e}", exc_info=True)
+        for record in records:
+            record.dirty_ = True
+
+        logger.warning(f"Save snapshot error: {e}", exc_info=True)
 
     return result
@@ -450,8 +450,7 @@ def is_class_e_user(user: Union[int, User]) -> bool:
         if uid in glovar.bot_ids:
             return True
 
-        group_list = list(glovar.trust_ids)
-        result = any(uid in glovar.trust_ids.get(gid, set()) for gid in group_list)
+        result = uid in glovar.trusted_ids
     except Exception as e:
         logger.warning(f"Is class e user error: {e}", exc_info=True)
 
@@ -600,10 +599,9 @@ def is_limited_user(gid: int, user: User, now: int, short: bool = True) -> bool:
         if short and now - join < glovar.time_short:
             return True
 
-        track = [gid for gid in glovar.user_ids[uid]["join"]
-                 if now - glovar.user_ids[uid]["join"][gid] < glovar.time_track]
+        track = glovar.user_ids[uid]["join"].count_since(now - glovar.time_track + 1, glovar.limit_track)
 
-        result = len(track) >= glovar.limit_track
+        result = track >= glovar.limit_track
     except Exception as e:
         logger.warning(f"Is limited user error: {e}", exc_info=True)
 
@@ -633,8 +631,7 @@ def is_new_user(user: User, now: int, gid: int = 0, joined: bool = False) -> boo
             join = glovar.user_ids[uid]["join"].get(gid, 0)
             return now - join < glovar.time_new
 
-        result = any(now - glovar.user_ids[uid]["join"].get(gid, 0) < glovar.time_new
-                     for gid in list(glovar.user_ids[uid]["join"]))
+        result = now - glovar.user_ids[uid]["join"].latest() < glovar.time_new
     except Exception as e:
         logger.warning(f"Is new user error: {e}", exc_info=True)
 
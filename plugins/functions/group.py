@@ -23,9 +23,10 @@ from pyrogram import Client
 from pyrogram.types import Chat, ChatMember, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
 
 from .. import glovar
-from .decorators import threaded
+from .decorators import prioritized, threaded
 from .etc import code, get_now, get_text_user, lang, mention_id, mention_name, mention_text, thread
 from .file import save
+from .ids import add_hint, get_hint_ids, set_trust
 from .telegram import delete_messages, get_chat, get_messages, leave_chat, send_message
 
 # Enable logging
@@ -61,58 +62,82 @@ def clear_joined_messages(client: Client, gid: int, mid: int) -> bool:
     return result
 
 
-def delete_hint(client: Client) -> bool:
-    # Delete hint messages
+def delete_group_hint(client: Client, gid: int, now: int) -> bool:
+    # Delete a group's hint messages that are no longer needed
     result = False
 
     try:
+        if gid not in glovar.message_ids:
+            return False
+
         # Basic data
-        now = get_now()
+        waiting = bool(glovar.wait_ids.get(gid))
 
-        # Get the wait group list
-        wait_group_list = {gid for uid in list(glovar.user_ids) for gid in list(glovar.user_ids[uid]["wait"])}
+        # Regular hint
+        mid = glovar.message_ids[gid]["hint"]
 
-        # Proceed
-        for gid in list(glovar.message_ids):
-            # Regular hint
-            mid = glovar.message_ids[gid]["hint"]
-
-            if mid and gid not in wait_group_list:
-                glovar.message_ids[gid]["hint"] = 0
-                delete_message(client, gid, mid)
+        if mid and not waiting:
+            glovar.message_ids[gid]["hint"] = 0
+            delete_message(client, gid, mid)
 
-            # Flood static hint
-            mids = glovar.message_ids[gid]["flood"]
+        # Flood static hint
+        mids = glovar.message_ids[gid]["flood"]
 
-            if mids and gid not in wait_group_list:
-                glovar.message_ids[gid]["flood"] = set()
-                thread(delete_messages, (client, gid, mids))
+        if mids and not waiting:
+            glovar.message_ids[gid]["flood"] = set()
+            thread(delete_messages, (client, gid, mids))
 
-            # Manual hint
-            if not glovar.message_ids[gid].get("manual", {}):
-                glovar.message_ids[gid]["manual"] = {}
+        # Manual hint and NOSPAM hint
+        for the_type in ["manual", "nospam"]:
+            if not glovar.message_ids[gid].get(the_type, {}):
+                glovar.message_ids[gid][the_type] = {}
 
-            for mid in list(glovar.message_ids[gid]["manual"]):
-                time = glovar.message_ids[gid]["manual"][mid]
+            for mid in list(glovar.message_ids[gid][the_type]):
+                time = glovar.message_ids[gid][the_type][mid]
 
-                if now - time < glovar.time_captcha and gid in wait_group_list:
+                if now - time < glovar.time_captcha and waiting:
                     continue
 
-                glovar.message_ids[gid]["nospam"].pop(mid, 0)
+                glovar.message_ids[gid][the_type].pop(mid, 0)
                 delete_message(client, gid, mid)
 
-            # NOSPAM hint
-            if not glovar.message_ids[gid].get("nospam", {}):
-                glovar.message_ids[gid]["nospam"] = {}
+        result = True
+    except Exception as e:
+        logger.warning(f"Delete group hint error: {e}", exc_info=True)
 
-            for mid in list(glovar.message_ids[gid]["nospam"]):
-                time = glovar.message_ids[gid]["nospam"][mid]
+    return result
 
-                if now - time < glovar.time_captcha and gid in wait_group_list:
-                    continue
 
-                glovar.message_ids[gid]["nospam"].pop(mid, 0)
-                delete_message(client, gid, mid)
+def delete_hint(client: Client, full: bool = False) -> bool:
+    # Delete hint messages of the groups marked by wait or hint changes, or of all groups if full
+    result = False
+
+    try:
+        # Basic data
+        now = get_now()
+
+        # Get the group list
+        if full:
+            gids = set(glovar.message_ids)
+        else:
+            gids = get_hint_ids(now)
+
+        if not gids:
+            return True
+
+        # Proceed
+        for gid in gids:
+            held = glovar.group_locks.try_acquire(gid)
+
+            # The group is busy in another thread, check it next time
+            if held is None:
+                add_hint(gid)
+                continue
+
+            try:
+                delete_group_hint(client, gid, now)
+            finally:
+                glovar.group_locks.release(held)
 
         # Save the data
         save("message_ids")
@@ -124,6 +149,7 @@ def delete_hint(client: Client) -> bool:
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def delete_message(client: Client, gid: int, mid: int) -> bool:
     # Delete a single message
@@ -257,7 +283,7 @@ def leave_group(client: Client, gid: int, reason: str = "") -> bool:
         glovar.pinned_ids.pop(gid, {})
         save("pinned_ids")
 
-        glovar.trust_ids.pop(gid, set())
+        set_trust(gid, None)
         save("trust_ids")
 
         glovar.configs.pop(gid, {})
@@ -320,9 +346,9 @@ def save_admins(gid: int, admin_members: List[ChatMember]) -> bool:
         save("admin_ids")
 
         # Trust list
-        glovar.trust_ids[gid] = {admin.user.id for admin in admin_members
-                                 if ((not admin.user.is_bot and not admin.user.is_deleted)
-                                     or admin.user.id in glovar.bot_ids)}
+        set_trust(gid, {admin.user.id for admin in admin_members
+                        if ((not admin.user.is_bot and not admin.user.is_deleted)
+                            or admin.user.id in glovar.bot_ids)})
         save("trust_ids")
 
         result = True
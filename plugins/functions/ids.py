@@ -18,14 +18,180 @@
 
 import logging
 from copy import deepcopy
+from heapq import heapify, heappop, heappush
+from math import exp
+from typing import Dict, Iterable, List, Set, Tuple
 
 from .. import glovar
+from ..records import UserStatus
+from ..storage import UserStore
+from .etc import get_now
 from .file import save
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def add_expiry(the_type: str, uid: int, until: int) -> bool:
+    # Add a user record or a watch entry to the expiry index
+    result = False
+
+    try:
+        heappush(glovar.expiry_heap, (until, the_type, uid))
+        result = True
+    except Exception as e:
+        logger.warning(f"Add expiry error: {e}", exc_info=True)
+
+    return result
+
+
+def add_hint(gid: int, due: int = 0) -> bool:
+    # Mark the group's hint messages for checking, now or at the due time
+    result = False
+
+    try:
+        with glovar.locks["hint"]:
+            if due:
+                heappush(glovar.hint_heap, (due, gid))
+            else:
+                glovar.hint_ids.add(gid)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Add hint error: {e}", exc_info=True)
+
+    return result
+
+
+def add_join(gid: int, now: int, count: int = 1) -> float:
+    # Count joins into the group's decaying join counter, return the current join rate
+    result = 0.0
+
+    try:
+        rate, last = glovar.join_rates.get(gid, (0.0, now))
+        result = rate * exp(min(last - now, 0) / glovar.time_join) + count
+        glovar.join_rates[gid] = (result, max(last, now))
+    except Exception as e:
+        logger.warning(f"Add join error: {e}", exc_info=True)
+
+    return result
+
+
+def check_wait_ids() -> int:
+    # Check the wait index against user records, repair it, return the count of wrong entries
+    result = 0
+
+    try:
+        wait_ids = get_wait_ids()
+
+        for gid in set(wait_ids) | set(glovar.wait_ids):
+            result += len(wait_ids.get(gid, set()) ^ glovar.wait_ids.get(gid, set()))
+
+        if not result:
+            return 0
+
+        glovar.wait_ids = wait_ids
+        logger.warning(f"Wait index repaired, {result} wrong entries")
+    except Exception as e:
+        logger.warning(f"Check wait ids error: {e}", exc_info=True)
+
+    return result
+
+
+def clear_wait(uid: int) -> bool:
+    # Remove the user from all wait lists
+    result = False
+
+    try:
+        for gid in list(glovar.user_ids[uid]["wait"]):
+            pop_wait(uid, gid)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Clear wait error: {e}", exc_info=True)
+
+    return result
+
+
+def get_hint_ids(now: int) -> Set[int]:
+    # Take the groups whose hint messages should be checked now
+    result = set()
+
+    try:
+        with glovar.locks["hint"]:
+            result, glovar.hint_ids = glovar.hint_ids, set()
+
+            while glovar.hint_heap and glovar.hint_heap[0][0] <= now:
+                result.add(heappop(glovar.hint_heap)[1])
+    except Exception as e:
+        logger.warning(f"Get hint ids error: {e}", exc_info=True)
+
+    return result
+
+
+def get_join_rate(gid: int, now: int) -> float:
+    # Get the group's join rate, about the count of joins in the last time_join seconds
+    result = 0.0
+
+    try:
+        rate, last = glovar.join_rates.get(gid, (0.0, now))
+        result = rate * exp(min(last - now, 0) / glovar.time_join)
+    except Exception as e:
+        logger.warning(f"Get join rate error: {e}", exc_info=True)
+
+    return result
+
+
+def get_wait_groups(uids: Iterable[int]) -> Set[int]:
+    # Get the groups the users wait in
+    result = set()
+
+    try:
+        for uid in uids:
+            uid in glovar.user_ids and result.update(glovar.user_ids[uid]["wait"])
+    except Exception as e:
+        logger.warning(f"Get wait groups error: {e}", exc_info=True)
+
+    return result
+
+
+def get_wait_ids() -> Dict[int, Set[int]]:
+    # Get the waiting users of every group from user records
+    result = {}
+
+    try:
+        records = glovar.user_ids.records if isinstance(glovar.user_ids, UserStore) else glovar.user_ids
+
+        for uid in list(records):
+            for gid, time in list(records[uid]["wait"].items()):
+                time and result.setdefault(gid, set()).add(uid)
+    except Exception as e:
+        logger.warning(f"Get wait ids error: {e}", exc_info=True)
+
+    return result
+
+
+def init_expiry() -> bool:
+    # Init the expiry index from user records and watch entries
+    result = False
+
+    try:
+        records = glovar.user_ids.records if isinstance(glovar.user_ids, UserStore) else glovar.user_ids
+        expiry_heap = [(records[uid].last_time() + glovar.time_idle, "user", uid) for uid in list(records)]
+
+        for the_type in ["ban", "delete"]:
+            expiry_heap += [(until, the_type, uid) for uid, until in list(glovar.watch_ids[the_type].items())]
+
+        heapify(expiry_heap)
+        glovar.expiry_heap = expiry_heap
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Init expiry error: {e}", exc_info=True)
+
+    return result
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     result = False
@@ -78,6 +244,25 @@ def init_group_id(gid: int) -> bool:
     return result
 
 
+def init_trusted_ids() -> bool:
+    # Init the trusted user index from the trust lists of all groups
+    result = False
+
+    try:
+        trusted_ids = {}
+
+        for gid in list(glovar.trust_ids):
+            for uid in glovar.trust_ids.get(gid, set()):
+                trusted_ids[uid] = trusted_ids.get(uid, 0) + 1
+
+        glovar.trusted_ids = trusted_ids
+        result = True
+    except Exception as e:
+        logger.warning(f"Init trusted ids error: {e}", exc_info=True)
+
+    return result
+
+
 def init_user_id(uid: int) -> bool:
     # Init user data
     result = False
@@ -86,11 +271,125 @@ def init_user_id(uid: int) -> bool:
         if glovar.user_ids.get(uid) is not None:
             return True
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
+        glovar.user_ids[uid] = UserStatus()
         save("user_ids")
+        add_expiry("user", uid, get_now() + glovar.time_idle)
 
         result = True
     except Exception as e:
         logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
 
     return result
+
+
+def init_wait_ids() -> bool:
+    # Init the wait index from user records
+    result = False
+
+    try:
+        glovar.wait_ids = get_wait_ids()
+        result = True
+    except Exception as e:
+        logger.warning(f"Init wait ids error: {e}", exc_info=True)
+
+    return result
+
+
+def lock_message(gids: Iterable[int] = (), uids: Iterable[int] = (),
+                 waiting: bool = False) -> Tuple[List[int], List[int]]:
+    # Hold the message lock shared with the stripes of the groups and users, and of the groups the users wait in
+    lock = glovar.locks["message"]
+    uids = list(uids)
+
+    while True:
+        the_gids = set(gids)
+        waiting and the_gids.update(get_wait_groups(uids))
+
+        lock.acquire_shared()
+        result = (glovar.group_locks.acquire(the_gids), glovar.user_locks.acquire(uids))
+
+        # Only threads holding the user stripes add wait groups
+        if not waiting or get_wait_groups(uids) <= the_gids:
+            break
+
+        unlock_message(result)
+
+    return result
+
+
+def pop_wait(uid: int, gid: int) -> int:
+    # Remove the user from a group's wait list, return the wait time
+    result = 0
+
+    try:
+        result = glovar.user_ids[uid]["wait"].pop(gid, 0)
+        wait_set = glovar.wait_ids.get(gid)
+
+        if wait_set is None:
+            return result
+
+        wait_set.discard(uid)
+
+        if wait_set:
+            return result
+
+        # Nobody is waiting, the group's hints can go
+        glovar.wait_ids.pop(gid, None)
+        add_hint(gid)
+    except Exception as e:
+        logger.warning(f"Pop wait error: {e}", exc_info=True)
+
+    return result
+
+
+def set_trust(gid: int, uids: Set[int]) -> bool:
+    # Replace a group's trust list, remove the group if uids is None, keep the trusted user index in step
+    result = False
+
+    try:
+        with glovar.locks["trust"]:
+            old_uids = glovar.trust_ids.get(gid, set())
+            new_uids = uids or set()
+
+            for uid in old_uids - new_uids:
+                count = glovar.trusted_ids.get(uid, 0) - 1
+
+                if count > 0:
+                    glovar.trusted_ids[uid] = count
+                else:
+                    glovar.trusted_ids.pop(uid, 0)
+
+            for uid in new_uids - old_uids:
+                glovar.trusted_ids[uid] = glovar.trusted_ids.get(uid, 0) + 1
+
+            if uids is None:
+                glovar.trust_ids.pop(gid, set())
+            else:
+                glovar.trust_ids[gid] = uids
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Set trust error: {e}", exc_info=True)
+
+    return result
+
+
+def set_wait(uid: int, gid: int, now: int) -> bool:
+    # Add the user to a group's wait list
+    result = False
+
+    try:
+        glovar.user_ids[uid]["wait"][gid] = now
+        glovar.wait_ids.setdefault(gid, set()).add(uid)
+        result = True
+    except Exception as e:
+        logger.warning(f"Set wait error: {e}", exc_info=True)
+
+    return result
+
+
+def unlock_message(held: Tuple[List[int], List[int]]) -> None:
+    # Release what lock_message returned
+    glovar.user_locks.release(held[1])
+    glovar.group_locks.release(held[0])
+    glovar.locks["message"].release_shared()
@@ -17,7 +17,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
 from copy import deepcopy
 from json import loads
 from typing import Any
@@ -26,21 +25,23 @@ from pyrogram import Client
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message
 
 from .. import glovar
+from ..records import UserStatus
+from ..storage import UserStore, read_data
 from .challenge import send_static, user_captcha
 from .channel import get_debug_text, send_debug, share_data
 from .config import get_config_text
 from .decorators import threaded
-from .etc import (code, crypt_str, delay, general_link, get_int, get_now, get_text, lang, thread, mention_id,
+from .etc import (add_delay, code, crypt_str, general_link, get_int, get_now, get_text, lang, thread, mention_id,
                   mention_text)
 from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
 from .filters import is_class_e_user, is_flooded, is_should_ignore
-from .group import delete_message, leave_group
-from .ids import init_group_id, init_user_id
+from .group import leave_group
+from .ids import add_expiry, clear_wait, init_expiry, init_group_id, init_trusted_ids, init_user_id, init_wait_ids
 from .telegram import (get_chat_member, get_chat_members_count, get_members, pin_chat_message, send_message,
                        send_report_message)
 from .timers import update_admins
-from .user import (flood_end, flood_user, forgive_user, forgive_users, kick_users, restrict_user, remove_failed_user,
-                   remove_new_users, remove_wait_user, terminate_user_banned)
+from .user import (flood_end, flood_user, forgive_user, forgive_users, init_deadlines, kick_users, restrict_user,
+                   remove_failed_user, remove_new_users, remove_wait_user, terminate_user_banned)
 
 # Enable logging
 logger = logging.getLogger(__name__)
@@ -197,7 +198,8 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
         elif data_type == "user":
             if the_type == "all":
                 forgive_users(client)
-                glovar.user_ids = {}
+                glovar.user_ids.clear()
+                init_wait_ids()
             elif the_type == "new":
                 remove_new_users()
 
@@ -228,7 +230,7 @@ def receive_clear_data(client: Client, data_type: str, data: dict) -> bool:
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('clear'))}\n"
                 f"{lang('more')}{lang('colon')}{code(f'{data_type} {the_type}')}\n")
-        result = thread(send_message, (client, glovar.debug_channel_id, text))
+        result = thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
     except Exception as e:
         logger.warning(f"Receive clear data: {e}", exc_info=True)
     finally:
@@ -379,10 +381,10 @@ def receive_file_data(client: Client, message: Message, decrypt: bool = True) ->
             path_final = path
 
         with open(path_final, "rb") as f:
-            result = pickle.load(f)
+            result = read_data(f)
 
         for f in {path, path_decrypted}:
-            thread(delete_file, (f,))
+            thread(delete_file, (f,), pool="file")
     except Exception as e:
         logger.warning(f"Receive file error: {e}", exc_info=True)
 
@@ -551,13 +553,13 @@ def receive_help_confirm(client: Client, data: dict) -> bool:
         last = glovar.pinned_ids[gid]["last"]
         new_id = glovar.pinned_ids[gid]["new_id"]
         old_id = glovar.pinned_ids[gid]["old_id"]
-        wait_user_list = [wid for wid in glovar.user_ids if glovar.user_ids[wid]["wait"].get(gid, 0)]
+        wait_user_list = list(glovar.wait_ids.get(gid, set()))
 
         # Pin old message
         old_id and thread(pin_chat_message, (client, gid, old_id))
 
         # Delete newly pinned message
-        new_id and delay(30, delete_message, [client, gid, new_id])
+        new_id and add_delay(30, "delete_message", [gid, new_id])
         glovar.pinned_ids[gid]["new_id"] = 0
 
         # Reset time status
@@ -650,7 +652,7 @@ def receive_leave_approve(client: Client, data: dict) -> bool:
             text += f"{lang('reason')}{lang('colon')}{code(reason)}\n"
 
         leave_group(client, the_id)
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -674,7 +676,7 @@ def receive_refresh(client: Client, data: int) -> bool:
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('refresh'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -768,8 +770,9 @@ def receive_remove_bad(client: Client, data: dict) -> bool:
             return True
 
         forgive_user(client, the_id)
+        clear_wait(the_id)
 
-        glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
+        glovar.user_ids[the_id] = UserStatus()
         save("user_ids")
 
         result = True
@@ -795,8 +798,9 @@ def receive_remove_score(client: Client, data: int) -> bool:
             return True
 
         forgive_user(client, uid)
+        clear_wait(uid)
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
+        glovar.user_ids[uid] = UserStatus()
         save("user_ids")
 
         result = True
@@ -863,15 +867,30 @@ def receive_rollback(client: Client, message: Message, data: dict) -> bool:
         if the_data is None:
             return False
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        if the_type.split(".")[0] == "user_ids":
+            the_data = {uid: UserStatus.from_dict(the_data[uid]) for uid in the_data}
+
+        if the_type.startswith("user_ids."):
+            rollback_shard(int(the_type.split(".")[-1]), the_data)
+        elif isinstance(eval(f"glovar.{the_type}"), UserStore):
+            eval(f"glovar.{the_type}").replace(the_data)
+        else:
+            exec(f"glovar.{the_type} = the_data")
+
+        save(the_type.split(".")[0])
+
+        # Rebuild the expiry, deadline, wait and trust indexes
+        the_type.split(".")[0] in {"user_ids", "watch_ids"} and init_expiry()
+        the_type.split(".")[0] == "user_ids" and init_deadlines()
+        the_type.split(".")[0] == "user_ids" and init_wait_ids()
+        the_type == "trust_ids" and init_trusted_ids()
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('admin_project')}{lang('colon')}{mention_id(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('rollback'))}\n"
                 f"{lang('more')}{lang('colon')}{code(the_type)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -976,6 +995,7 @@ def receive_watch_user(data: dict) -> bool:
             return False
 
         save("watch_ids")
+        add_expiry(the_type, uid, until)
 
         result = True
     except Exception as e:
@@ -1002,3 +1022,28 @@ def receive_white_users(client: Client, message: Message) -> bool:
         logger.warning(f"Receive white users error: {e}", exc_info=True)
 
     return result
+
+
+def rollback_shard(index: int, data: dict) -> bool:
+    # Replace the users in a shard of user_ids
+    result = False
+
+    glovar.locks["message"].acquire()
+
+    try:
+        count = glovar.limit_shard
+
+        # Only drop the users of the bucket if the shard was written with the same shard count
+        if all(uid % count == index for uid in data):
+            for uid in [uid for uid in list(glovar.user_ids) if uid % count == index]:
+                glovar.user_ids.pop(uid, None)
+
+        glovar.user_ids.update(data)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Rollback shard error: {e}", exc_info=True)
+    finally:
+        glovar.locks["message"].release()
+
+    return result
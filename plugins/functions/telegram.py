@@ -17,7 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from typing import Generator, Iterable, List, Optional, Union
+from inspect import iscoroutine, unwrap
+from typing import Any, Coroutine, Dict, Generator, Iterable, List, Optional, Union
 
 from pyrogram import Client
 from pyrogram.types import (InputMediaPhoto, InlineKeyboardMarkup, ReplyKeyboardMarkup, Message, Chat, ChatMember,
@@ -30,34 +31,31 @@ from pyrogram.errors import (ChatAdminRequired, ChatNotModified, ButtonDataInval
                              QueryIdInvalid, UsernameInvalid, UsernameNotOccupied, UserNotParticipant)
 
 from .. import glovar
-from .decorators import retry, threaded
-from .etc import delay, get_int, wait_flood
+from .decorators import awaitable, prioritized, retry, threaded, variant
+from .etc import add_delay, get_int, get_priority, sleep_flood, sleep_rate, wait_flood, wait_rate
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
-@retry
+@awaitable
+@prioritized("captcha")
 def answer_callback(client: Client, callback_query_id: str, text: str, show_alert: bool = False) -> Optional[bool]:
     # Answer the callback
-    result = None
-
-    try:
-        result = client.answer_callback_query(
-            callback_query_id=callback_query_id,
-            text=text,
-            show_alert=show_alert
-        )
-    except FloodWait as e:
-        raise e
-    except QueryIdInvalid:
-        return False
-    except Exception as e:
-        logger.warning(f"Answer query to {callback_query_id} error: {e}", exc_info=True)
-
-    return result
-
-
+    return request(
+        client=client,
+        method="answer_callback_query",
+        kwargs={
+            "callback_query_id": callback_query_id,
+            "text": text,
+            "show_alert": show_alert
+        },
+        errors={QueryIdInvalid: False},
+        text=f"Answer query to {callback_query_id}"
+    )
+
+
+@awaitable
 def delete_messages(client: Client, cid: int, mids: Iterable[int]) -> Optional[bool]:
     # Delete some messages
     result = None
@@ -69,29 +67,25 @@ def delete_messages(client: Client, cid: int, mids: Iterable[int]) -> Optional[b
             return delete_messages_100(client, cid, mids)
 
         mids_list = [mids[i:i + 100] for i in range(0, len(mids), 100)]
-        result = bool([delete_messages_100(client, cid, mids) for mids in mids_list])
+        result = join_requests([delete_messages_100(client, cid, mids) for mids in mids_list])
     except Exception as e:
         logger.warning(f"Delete messages in {cid} error: {e}", exc_info=True)
 
     return result
 
 
-@retry
 def delete_messages_100(client: Client, cid: int, mids: Iterable[int]) -> Optional[bool]:
     # Delete some messages
-    result = None
-
-    try:
-        mids = list(mids)
-        result = client.delete_messages(chat_id=cid, message_ids=mids)
-    except FloodWait as e:
-        raise e
-    except MessageDeleteForbidden:
-        return False
-    except Exception as e:
-        logger.warning(f"Delete messages in {cid} error: {e}", exc_info=True)
-
-    return result
+    return request(
+        client=client,
+        method="delete_messages",
+        kwargs={
+            "chat_id": cid,
+            "message_ids": list(mids)
+        },
+        errors={MessageDeleteForbidden: False},
+        text=f"Delete messages in {cid}"
+    )
 
 
 @retry
@@ -100,6 +94,9 @@ def download_media(client: Client, file_id: str, file_path: str) -> Optional[str
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.download_media(message=file_id, file_name=file_path)
     except FloodWait as e:
         raise e
@@ -121,6 +118,9 @@ def edit_message_photo(client: Client, cid: int, mid: int, photo: str, caption:
             caption=caption,
             parse_mode="html"
         )
+        if not wait_rate(1, cid):
+            return result
+
         result = client.edit_message_media(
             chat_id=cid,
             message_id=mid,
@@ -139,30 +139,25 @@ def edit_message_photo(client: Client, cid: int, mid: int, photo: str, caption:
     return result
 
 
-@retry
+@awaitable
 def edit_message_reply_markup(client: Client, cid: int, mid: int,
                               markup: InlineKeyboardMarkup = None) -> Union[bool, Message, None]:
     # Edit the message's reply markup
-    result = None
-
-    try:
-        result = client.edit_message_reply_markup(
-            chat_id=cid,
-            message_id=mid,
-            reply_markup=markup
-        )
-    except FloodWait as e:
-        raise e
-    except (ButtonDataInvalid, ButtonUrlInvalid):
-        logger.warning(f"Edit message {mid} reply markup in {cid} - invalid markup: {markup}")
-    except MessageNotModified:
-        return None
-    except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
-        return False
-    except Exception as e:
-        logger.warning(f"Edit message {mid} reply markup in {cid} error: {e}", exc_info=True)
-
-    return result
+    return request(
+        client=client,
+        method="edit_message_reply_markup",
+        kwargs={
+            "chat_id": cid,
+            "message_id": mid,
+            "reply_markup": markup
+        },
+        rate=(1, cid),
+        errors={
+            MessageNotModified: None,
+            (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid): False
+        },
+        text=f"Edit message {mid} reply markup in {cid}"
+    )
 
 
 @retry
@@ -175,6 +170,9 @@ def edit_message_text(client: Client, cid: int, mid: int, text: str,
         if not text.strip():
             return None
 
+        if not wait_rate(1, cid):
+            return result
+
         result = client.edit_message_text(
             chat_id=cid,
             message_id=mid,
@@ -203,6 +201,9 @@ def export_chat_invite_link(client: Client, cid: int) -> Union[bool, str, None]:
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.export_chat_invite_link(chat_id=cid)
     except FloodWait as e:
         raise e
@@ -222,6 +223,9 @@ def forward_messages(client: Client, cid: int, fid: int,
     result = None
 
     try:
+        if not wait_rate(1, cid):
+            return result
+
         result = client.forward_messages(
             chat_id=cid,
             from_chat_id=fid,
@@ -249,6 +253,9 @@ def get_admins(client: Client, cid: int) -> Union[bool, List[ChatMember], None]:
         if isinstance(chat, Chat) and not chat.members_count:
             return False
 
+        if not wait_rate():
+            return result
+
         result = client.get_chat_members(chat_id=cid, filter="administrators")
     except FloodWait as e:
         raise e
@@ -266,6 +273,9 @@ def get_chat(client: Client, cid: Union[int, str]) -> Union[Chat, ChatPreview, N
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.get_chat(chat_id=cid)
     except FloodWait as e:
         raise e
@@ -283,6 +293,9 @@ def get_chat_member(client: Client, cid: int, uid: int) -> Union[bool, ChatMembe
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.get_chat_member(chat_id=cid, user_id=uid)
     except FloodWait as e:
         raise e
@@ -300,6 +313,9 @@ def get_chat_members_count(client: Client, cid: int) -> Optional[int]:
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.get_chat_members_count(chat_id=cid)
     except FloodWait as e:
         raise e
@@ -348,6 +364,9 @@ def get_me(client: Client) -> Optional[User]:
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.get_me()
     except FloodWait as e:
         raise e
@@ -363,6 +382,9 @@ def get_members(client: Client, cid: int, query: str = "all") -> Optional[Genera
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.iter_chat_members(chat_id=cid, filter=query)
     except FloodWait as e:
         raise e
@@ -378,6 +400,9 @@ def get_messages(client: Client, cid: int, mids: Union[int, Iterable[int]]) -> U
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.get_messages(chat_id=cid, message_ids=mids)
     except FloodWait as e:
         raise e
@@ -417,6 +442,9 @@ def get_user_full(client: Client, uid: int) -> Optional[UserFull]:
         if not user_id:
             return None
 
+        if not wait_rate():
+            return result
+
         result = client.send(GetFullUser(id=user_id))
     except FloodWait as e:
         raise e
@@ -426,68 +454,126 @@ def get_user_full(client: Client, uid: int) -> Optional[UserFull]:
     return result
 
 
+def join_requests(results: List[Any]) -> Union[bool, Coroutine]:
+    # Join the results of some requests, await them in order if they are coroutines of the async variant
+    async def join() -> bool:
+        for result in results:
+            await result
+
+        return True
+
+    if not any(iscoroutine(result) for result in results):
+        return bool(results)
+
+    return join()
+
+
+@awaitable
 def kick_chat_member(client: Client, cid: int, uid: Union[int, str],
                      until_date: int = 0) -> Union[bool, Message, None]:
     # Kick a chat member in a group
+    return request(
+        client=client,
+        method="kick_chat_member",
+        kwargs={
+            "chat_id": cid,
+            "user_id": uid,
+            "until_date": until_date
+        },
+        errors={PeerIdInvalid: False},
+        text=f"Kick chat member {uid} in {cid}"
+    )
+
+
+@awaitable
+def leave_chat(client: Client, cid: int, delete: bool = False) -> bool:
+    # Leave a channel
+    return request(
+        client=client,
+        method="leave_chat",
+        kwargs={
+            "chat_id": cid,
+            "delete": delete
+        },
+        errors={(ChannelInvalid, ChannelPrivate, PeerIdInvalid): False},
+        text=f"Leave chat {cid}",
+        done=True
+    ) or False
+
+
+@awaitable
+def pin_chat_message(client: Client, cid: int, mid: int) -> Optional[bool]:
+    # Pin a message in a group, channel or your own chat
+    return request(
+        client=client,
+        method="pin_chat_message",
+        kwargs={
+            "chat_id": cid,
+            "message_id": mid,
+            "disable_notification": True
+        },
+        errors={(ChannelInvalid, ChannelPrivate, ChatAdminRequired, ChatNotModified, PeerIdInvalid): False},
+        text="Pin chat message"
+    )
+
+
+def request(client: Client, method: str, kwargs: Dict[str, Any], rate: tuple = (), errors: dict = None,
+            text: str = "", done: Any = None) -> Any:
+    # Make a request with the rate limit and the FloodWait retry, the async variant returns a coroutine instead
     result = None
 
-    try:
-        result = client.kick_chat_member(chat_id=cid, user_id=uid, until_date=until_date)
-    except FloodWait as e:
-        logger.warning(f"Kick chat member {uid} in {cid} - Sleep for {e.x} second(s)")
+    if getattr(variant, "asynchronous", False):
+        return request_async(client, method, kwargs, rate, errors, text, done, get_priority())
 
-        if until_date:
-            new_date = until_date + e.x
-        else:
-            new_date = 0
+    while True:
+        try:
+            if not wait_rate(*rate):
+                return result
 
-        wait_flood(e)
+            result = getattr(client, method)(**kwargs)
 
-        return kick_chat_member(client, cid, uid, new_date)
-    except PeerIdInvalid:
-        return False
-    except Exception as e:
-        logger.warning(f"Kick chat member {uid} in {cid} error: {e}", exc_info=True)
+            return result if done is None else (result or done)
+        except FloodWait as e:
+            logger.warning(f"{text} - Sleep for {e.x} second(s)")
+            kwargs.get("until_date") and kwargs.update(until_date=kwargs["until_date"] + e.x)
+            wait_flood(e)
+        except Exception as e:
+            return request_error(e, kwargs, errors, text)
 
-    return result
 
+async def request_async(client: Client, method: str, kwargs: Dict[str, Any], rate: tuple, errors: Optional[dict],
+                        text: str, done: Any, level: str) -> Any:
+    # Await the native coroutine of the client method, wait for the rate limit and FloodWait on the event loop
+    result = None
 
-@retry
-def leave_chat(client: Client, cid: int, delete: bool = False) -> bool:
-    # Leave a channel
-    result = False
+    while True:
+        try:
+            if not await sleep_rate(level, *rate):
+                return result
 
-    try:
-        result = client.leave_chat(chat_id=cid, delete=delete) or True
-    except FloodWait as e:
-        raise e
-    except (ChannelInvalid, ChannelPrivate, PeerIdInvalid):
-        return False
-    except Exception as e:
-        logger.warning(f"Leave chat {cid} error: {e}", exc_info=True)
+            result = await unwrap(getattr(type(client), method))(client, **kwargs)
 
-    return result
+            return result if done is None else (result or done)
+        except FloodWait as e:
+            logger.warning(f"{text} - Sleep for {e.x} second(s)")
+            kwargs.get("until_date") and kwargs.update(until_date=kwargs["until_date"] + e.x)
+            await sleep_flood(e)
+        except Exception as e:
+            return request_error(e, kwargs, errors, text)
 
 
-@retry
-def pin_chat_message(client: Client, cid: int, mid: int) -> Optional[bool]:
-    # Pin a message in a group, channel or your own chat
-    result = None
+def request_error(e: Exception, kwargs: Dict[str, Any], errors: Optional[dict], text: str) -> Any:
+    # Get the result of a failed request, log the unexpected errors
+    for error, value in (errors or {}).items():
+        if isinstance(e, error):
+            return value
 
-    try:
-        result = client.pin_chat_message(
-            chat_id=cid,
-            message_id=mid,
-            disable_notification=True
-        )
-    except FloodWait as e:
-        raise e
-    except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, ChatNotModified, PeerIdInvalid):
-        return False
-    except Exception as e:
-        logger.warning(f"Pin chat message error: {e}", exc_info=True)
+    if isinstance(e, (ButtonDataInvalid, ButtonUrlInvalid)):
+        logger.warning(f"{text} - invalid markup: {kwargs.get('reply_markup')}")
+    else:
+        logger.warning(f"{text} error: {e}", exc_info=True)
 
-    return result
+    return None
 
 
 @retry
@@ -496,6 +582,9 @@ def resolve_peer(client: Client, pid: Union[int, str]) -> Union[bool, InputChann
     result = None
 
     try:
+        if not wait_rate():
+            return result
+
         result = client.resolve_peer(pid)
     except FloodWait as e:
         raise e
@@ -549,34 +638,21 @@ def resolve_username(client: Client, username: str, cache: bool = True) -> (str,
     return peer_type, peer_id
 
 
-@retry
+@awaitable
 def restrict_chat_member(client: Client, cid: int, uid: int, permissions: ChatPermissions,
                          until_date: int = 0) -> Optional[Chat]:
     # Restrict a user in a supergroup
-    result = None
-
-    try:
-        result = client.restrict_chat_member(
-            chat_id=cid,
-            user_id=uid,
-            permissions=permissions,
-            until_date=until_date
-        )
-    except FloodWait as e:
-        logger.warning(f"Restrict chat member {uid} in {cid} - Sleep for {e.x} second(s)")
-
-        if until_date:
-            new_date = until_date + e.x
-        else:
-            new_date = 0
-
-        wait_flood(e)
-
-        return restrict_chat_member(client, cid, uid, permissions, new_date)
-    except Exception as e:
-        logger.warning(f"Restrict chat member {uid} in {cid} error: {e}", exc_info=True)
-
-    return result
+    return request(
+        client=client,
+        method="restrict_chat_member",
+        kwargs={
+            "chat_id": cid,
+            "user_id": uid,
+            "permissions": permissions,
+            "until_date": until_date
+        },
+        text=f"Restrict chat member {uid} in {cid}"
+    )
 
 
 @retry
@@ -586,6 +662,9 @@ def send_document(client: Client, cid: int, document: str, caption: str = "", mi
     result = None
 
     try:
+        if not wait_rate(1, cid):
+            return result
+
         result = client.send_document(
             chat_id=cid,
             document=document,
@@ -606,34 +685,28 @@ def send_document(client: Client, cid: int, document: str, caption: str = "", mi
     return result
 
 
-@retry
+@awaitable
 def send_message(client: Client, cid: int, text: str, mid: int = None,
                  markup: Union[InlineKeyboardMarkup, ReplyKeyboardMarkup] = None) -> Union[bool, Message, None]:
     # Send a message to a chat
-    result = None
-
-    try:
-        if not text.strip():
-            return None
-
-        result = client.send_message(
-            chat_id=cid,
-            text=text,
-            parse_mode="html",
-            disable_web_page_preview=True,
-            reply_to_message_id=mid,
-            reply_markup=markup
-        )
-    except FloodWait as e:
-        raise e
-    except (ButtonDataInvalid, ButtonUrlInvalid):
-        logger.warning(f"Send message to {cid} - invalid markup: {markup}")
-    except (ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid):
-        return False
-    except Exception as e:
-        logger.warning(f"Send message to {cid} error: {e}", exc_info=True)
+    if not text.strip():
+        return None
 
-    return result
+    return request(
+        client=client,
+        method="send_message",
+        kwargs={
+            "chat_id": cid,
+            "text": text,
+            "parse_mode": "html",
+            "disable_web_page_preview": True,
+            "reply_to_message_id": mid,
+            "reply_markup": markup
+        },
+        rate=(1, cid),
+        errors={(ChannelInvalid, ChannelPrivate, ChatAdminRequired, PeerIdInvalid): False},
+        text=f"Send message to {cid}"
+    )
 
 
 @retry
@@ -646,6 +719,9 @@ def send_photo(client: Client, cid: int, photo: str, caption: str = "", mid: int
         if not photo.strip():
             return None
 
+        if not wait_rate(1, cid):
+            return result
+
         result = client.send_photo(
             chat_id=cid,
             photo=photo,
@@ -669,10 +745,13 @@ def send_photo(client: Client, cid: int, photo: str, caption: str = "", mid: int
 @threaded()
 def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int = None,
                         markup: InlineKeyboardMarkup = None) -> Optional[bool]:
-    # Send a message that will be auto deleted to a chat
+    # Send a message that will be auto deleted to a chat, skip it if it would wait longer than it lives
     result = None
 
     try:
+        if not wait_rate(0, cid, secs):
+            return None
+
         result = send_message(
             client=client,
             cid=cid,
@@ -686,23 +765,22 @@ def send_report_message(secs: int, client: Client, cid: int, text: str, mid: int
 
         mid = result.message_id
         mids = [mid]
-        result = delay(secs, delete_messages, [client, cid, mids])
+        result = bool(add_delay(secs, "delete_messages", [cid, mids]))
     except Exception as e:
         logger.warning(f"Send report message to {cid} error: {e}", exc_info=True)
 
     return result
 
 
-@retry
+@awaitable
 def unban_chat_member(client: Client, cid: int, uid: Union[int, str]) -> Optional[bool]:
     # Unban a user in a group
-    result = None
-
-    try:
-        result = client.unban_chat_member(chat_id=cid, user_id=uid)
-    except FloodWait as e:
-        raise e
-    except Exception as e:
-        logger.warning(f"Unban chat member {uid} in {cid} error: {e}", exc_info=True)
-
-    return result
+    return request(
+        client=client,
+        method="unban_chat_member",
+        kwargs={
+            "chat_id": cid,
+            "user_id": uid
+        },
+        text=f"Unban chat member {uid} in {cid}"
+    )
@@ -17,48 +17,102 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from copy import deepcopy
-from time import sleep
-from typing import Dict
-
+from bisect import bisect
+from heapq import heapify, heappop, heappush
+from queue import Queue
+from time import sleep, time
+from typing import Any, Callable, Dict, List, Union
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobEvent
+from apscheduler.schedulers.base import BaseScheduler
 from pyrogram import Client
+from pyrogram.types import ChatMember
 
 from .. import glovar
+from ..locks import get_waited
+from ..storage import UserStore, get_shard_paths
 from .channel import share_data, share_regex_count
 from .decorators import threaded
-from .etc import code, general_link, get_now, get_readable_time, lang, thread
-from .file import file_tsv, save
+from .etc import code, general_link, get_memory_status, get_memory_text, get_now, get_readable_time, lang, thread
+from .etc import get_job_text, run_priority
+from .file import compact_files, data_to_file, delete_file, file_tsv, get_file_hash, save, save_all
 from .filters import is_class_e_user, is_flooded
-from .group import delete_hint, leave_group, save_admins
+from .group import delete_hint, delete_message, leave_group, save_admins
+from .ids import check_wait_ids, get_join_rate
 from .telegram import export_chat_invite_link, get_admins, get_group_info
-from .telegram import get_members, send_message
-from .user import check_timeout_user, forgive_users, kick_user, lift_ban, remove_group_user, unban_user
+from .telegram import delete_messages, get_members, send_message
+from .user import change_member_status, kick_user, remove_captcha_group, unban_user
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
-@threaded()
+@threaded(pool="file")
 def backup_files(client: Client) -> bool:
-    # Backup data files to BACKUP
+    # Backup changed data files to BACKUP
     result = False
 
     try:
+        # Write the changed data and fresh snapshots first
+        save_all()
+        compact_files()
+
+        shared = False
+
         for file in glovar.file_list:
-            # Check
-            if not eval(f"glovar.{file}"):
+            # Check the manifest, it is shared at last
+            if file == "backup_manifest":
                 continue
 
-            # Share
-            share_data(
-                client=client,
-                receivers=["BACKUP"],
-                action="backup",
-                action_type="data",
-                data=file,
-                file=f"data/{file}"
-            )
-            sleep(5)
+            # Check, a lazy variable that was never loaded is still up to date in its file
+            if (file not in glovar.lazy_defaults or file in vars(glovar)) and not eval(f"glovar.{file}"):
+                continue
+
+            # Get the files
+            if isinstance(eval(f"glovar.{file}"), UserStore):
+                files = {file: data_to_file(eval(f"glovar.{file}"))}
+            elif file == "user_ids" and glovar.limit_shard > 1:
+                paths = get_shard_paths(file)
+                files = {f"{file}.{index}": paths[index] for index in sorted(paths)}
+            else:
+                files = {file: f"data/{file}"}
+
+            # Share the changed files, the manifest only records the shared ones
+            for name in files:
+                file_hash = get_file_hash(files[name])
+
+                if not file_hash or glovar.backup_manifest.get(name) == file_hash:
+                    files[name].startswith("tmp/") and thread(delete_file, (files[name],), pool="file")
+                    continue
+
+                # Share in this thread to check the result, sync skips the share priority class of share_data
+                if not run_priority("share", share_data.sync, (), {
+                    "client": client,
+                    "receivers": ["BACKUP"],
+                    "action": "backup",
+                    "action_type": "data",
+                    "data": name,
+                    "file": files[name]
+                }):
+                    continue
+
+                glovar.backup_manifest[name] = file_hash
+                shared = True
+                sleep(5)
+
+        if not shared:
+            return True
+
+        # Share the manifest, so the full set can be reconstructed
+        save("backup_manifest")
+        share_data(
+            client=client,
+            receivers=["BACKUP"],
+            action="backup",
+            action_type="data",
+            data="backup_manifest",
+            file=data_to_file(glovar.backup_manifest)
+        )
 
         result = True
     except Exception as e:
@@ -123,6 +177,146 @@ def clear_members(client: Client) -> bool:
     return result
 
 
+def delay_loop(client: Client) -> None:
+    # Dispatch the delayed actions when they are due, actions left from the last run are replayed
+    with glovar.delay_condition:
+        glovar.delay_heap = [(glovar.delays[the_id]["time"], the_id) for the_id in list(glovar.delays)]
+        heapify(glovar.delay_heap)
+        saved = glovar.delay_stats["added"]
+
+    while True:
+        try:
+            due_list = []
+
+            with glovar.delay_condition:
+                if glovar.delay_heap:
+                    glovar.delay_condition.wait(max(glovar.delay_heap[0][0] - time(), 0))
+                else:
+                    glovar.delay_condition.wait(60)
+
+                now = time()
+                added = glovar.delay_stats["added"]
+
+                while glovar.delay_heap and glovar.delay_heap[0][0] <= now:
+                    due, the_id = heappop(glovar.delay_heap)
+                    the_id in glovar.delays and due_list.append((due, the_id))
+
+            # Persist the newly added actions, a finished action is saved by run_delay
+            if added != saved:
+                save("delays")
+                saved = added
+
+            for due, the_id in due_list:
+                lag = now - due
+                glovar.delay_stats["dispatched"] += 1
+                glovar.delay_stats["lag"] += lag
+                glovar.delay_stats["max"] = max(glovar.delay_stats["max"], lag)
+                thread(run_delay, (client, the_id))
+        except Exception as e:
+            logger.warning(f"Delay loop error: {e}", exc_info=True)
+            sleep(1)
+
+
+def expire_ids() -> bool:
+    # Remove idle user records and expired watch entries, a slice at a time
+    result = False
+
+    try:
+        # Basic data
+        now = get_now()
+        heap = glovar.expiry_heap
+        removed = {"user": 0, "ban": 0, "delete": 0}
+
+        while heap and heap[0][0] <= now:
+            # Hold the lock for a small slice only
+            with glovar.locks["message"]:
+                for _ in range(100):
+                    if not heap or heap[0][0] > now:
+                        break
+
+                    _, the_type, uid = heappop(heap)
+
+                    # Watch entries expire at their until time
+                    if the_type != "user":
+                        until = glovar.watch_ids[the_type].get(uid, 0)
+
+                        if not until:
+                            continue
+
+                        if until > now:
+                            heappush(heap, (until, the_type, uid))
+                            continue
+
+                        glovar.watch_ids[the_type].pop(uid, 0)
+                        removed[the_type] += 1
+                        continue
+
+                    # User records expire after the idle time, or after the keep time if they hold a pass,
+                    # punishment or manual state, a challenge state is kept until its deadline clears it
+                    records = glovar.user_ids.records if isinstance(glovar.user_ids, UserStore) else glovar.user_ids
+                    user_status = records.get(uid)
+
+                    if user_status is None:
+                        continue
+
+                    if user_status.is_active():
+                        heappush(heap, (now + glovar.time_idle, the_type, uid))
+                        continue
+
+                    ttl = glovar.time_keep if user_status.has_state() else glovar.time_idle
+                    until = user_status.last_time() + ttl
+
+                    if until > now:
+                        heappush(heap, (until, the_type, uid))
+                        continue
+
+                    del glovar.user_ids[uid]
+                    removed[the_type] += 1
+
+        removed["user"] and save("user_ids")
+        (removed["ban"] or removed["delete"]) and save("watch_ids")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Expire ids error: {e}", exc_info=True)
+
+    return result
+
+
+def get_job_stats(name: str) -> Dict[str, Union[float, int, List[int]]]:
+    # Get the stats of a scheduled job, create them on first use
+    return glovar.job_stats.setdefault(name, {
+        "runs": 0,
+        "failed": 0,
+        "missed": 0,
+        "skipped": 0,
+        "buckets": [0] * (len(glovar.job_buckets) + 1),
+        "total": 0.0,
+        "max": 0.0,
+        "lock": 0.0,
+        "last": 0
+    })
+
+
+def instrument_jobs(scheduler: BaseScheduler) -> bool:
+    # Record the duration, result and lock wait time of every scheduled job, and the missed or skipped runs
+    result = False
+
+    try:
+        for job in scheduler.get_jobs():
+            glovar.job_names[job.id] = job.name
+            # A threaded job runs in the scheduler thread, so its duration covers the work, not only the submit
+            job.modify(func=run_job, args=(job.name, getattr(job.func, "sync", job.func), *job.args))
+
+        scheduler.add_listener(job_listener, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Instrument jobs error: {e}", exc_info=True)
+
+    return result
+
+
 def interval_hour_01() -> bool:
     # Execute every hour
     result = False
@@ -164,20 +358,6 @@ def interval_min_01(client: Client) -> bool:
         # Basic data
         now = get_now()
 
-        # Check users
-        for uid in list(glovar.user_ids):
-            # Remove users from the CAPTCHA group
-            remove_group_user(client, uid, now)
-
-            # Terminate timeout users
-            check_timeout_user(client, uid, now)
-
-            # Lift the ban on users
-            lift_ban(client, uid, now)
-
-        # Save the user_ids
-        save("user_ids")
-
         # Clear changed ids
         glovar.changed_ids = set()
 
@@ -200,12 +380,16 @@ def interval_min_01(client: Client) -> bool:
                 continue
 
             # Get group's waiting user list
-            wait_user_list = [wid for wid in glovar.user_ids if glovar.user_ids[wid]["wait"].get(gid, 0)]
+            wait_user_list = glovar.wait_ids.get(gid, set())
 
             # Flood situation ongoing
             if len(wait_user_list) > glovar.limit_flood:
                 continue
 
+            # Join rate still high
+            if get_join_rate(gid, now) > glovar.limit_join / 2:
+                continue
+
             # Ask for help
             glovar.flooded_ids.add(gid)
             save("flooded_ids")
@@ -248,6 +432,14 @@ def interval_min_10(client: Client) -> bool:
         # New invite link
         new_invite_link(client)
 
+        # Check the wait index
+        with glovar.locks["message"]:
+            check_wait_ids()
+
+        # Check hint messages of all groups
+        with glovar.locks["message"]:
+            delete_hint(client, True)
+
         result = True
     except Exception as e:
         logger.warning(f"Interval min 10 error: {e}", exc_info=True)
@@ -255,6 +447,25 @@ def interval_min_10(client: Client) -> bool:
     return result
 
 
+def job_listener(event: JobEvent) -> bool:
+    # Count a missed run, or a run skipped because the last one is still running
+    result = False
+
+    try:
+        stats = get_job_stats(glovar.job_names.get(event.job_id, event.job_id))
+
+        if event.code == EVENT_JOB_MAX_INSTANCES:
+            stats["skipped"] += 1
+        else:
+            stats["missed"] += 1
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Job listener error: {e}", exc_info=True)
+
+    return result
+
+
 def new_invite_link(client: Client, force: bool = False) -> bool:
     # Generate new invite link
     result = False
@@ -269,12 +480,11 @@ def new_invite_link(client: Client, force: bool = False) -> bool:
         if not force and any(is_flooded(gid) for gid in list(glovar.configs)):
             return False
 
-        # Copy the data
+        # Check if there is a waiting
         with glovar.locks["message"]:
-            user_ids = deepcopy(glovar.user_ids)
+            waiting = any(glovar.wait_ids.values())
 
-        # Check if there is a waiting
-        if not force and any(user_ids[uid]["wait"] for uid in user_ids):
+        if not force and waiting:
             return False
 
         # Check the link time
@@ -306,7 +516,7 @@ def new_invite_link(client: Client, force: bool = False) -> bool:
 
 
 def reset_data(client: Client) -> bool:
-    # Reset user data every month
+    # Reset bad data every month, user records and watch entries expire by time instead
     result = False
 
     glovar.locks["message"].acquire()
@@ -329,20 +539,10 @@ def reset_data(client: Client) -> bool:
         glovar.left_group_ids = set()
         save("left_group_ids")
 
-        forgive_users(client)
-        glovar.user_ids = {}
-        save("user_ids")
-
-        glovar.watch_ids = {
-            "ban": {},
-            "delete": {}
-        }
-        save("watch_ids")
-
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('reset'))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -353,6 +553,65 @@ def reset_data(client: Client) -> bool:
     return result
 
 
+def run_job(name: str, func: Callable, *args) -> Any:
+    # Run a scheduled job and record it, a job returns False when it failed
+    result = None
+
+    start = time()
+    waited = get_waited()
+
+    try:
+        result = func(*args)
+    finally:
+        duration = time() - start
+        stats = get_job_stats(name)
+        stats["runs"] += 1
+        stats["buckets"][bisect(glovar.job_buckets, duration)] += 1
+        stats["total"] += duration
+        stats["max"] = max(stats["max"], duration)
+        stats["lock"] += get_waited() - waited
+
+        if not result:
+            stats["failed"] += 1
+        else:
+            stats["last"] = get_now()
+
+    return result
+
+
+def run_delay(client: Client, the_id: str) -> bool:
+    # Run a delayed action, remove it from the queue after it ran, so a crash replays it
+    result = False
+
+    try:
+        delay_data = glovar.delays.get(the_id)
+
+        if not delay_data:
+            return False
+
+        actions = {
+            "change_member_status": change_member_status,
+            "delete_message": delete_message,
+            "delete_messages": delete_messages,
+            "remove_captcha_group": remove_captcha_group
+        }
+        action = actions.get(delay_data["action"])
+
+        if action:
+            action(client, *delay_data["args"])
+        else:
+            logger.warning(f"Unknown delayed action: {delay_data['action']}")
+
+        glovar.delays.pop(the_id, None)
+        save("delays")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Run delay error: {e}", exc_info=True)
+
+    return result
+
+
 def send_count(client: Client) -> bool:
     # Send regex count to REGEX
     result = False
@@ -378,6 +637,40 @@ def send_count(client: Client) -> bool:
     return result
 
 
+def send_jobs(client: Client) -> bool:
+    # Send the scheduled job report to the debug channel
+    result = False
+
+    try:
+        text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
+                f"{lang('action')}{lang('colon')}{code(lang('status_jobs'))}\n"
+                f"{get_job_text()}")
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Send jobs error: {e}", exc_info=True)
+
+    return result
+
+
+def send_memory(client: Client) -> bool:
+    # Send the memory report to the debug channel
+    result = False
+
+    try:
+        text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
+                f"{lang('action')}{lang('colon')}{code(lang('status_memory'))}\n"
+                f"{get_memory_text(get_memory_status(True))}")
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Send memory error: {e}", exc_info=True)
+
+    return result
+
+
 @threaded()
 def share_failed_users(client: Client, data: Dict[str, int] = None) -> bool:
     # Share failed users
@@ -445,97 +738,141 @@ def update_admins(client: Client) -> bool:
     # Update admin list every day
     result = False
 
-    glovar.locks["admin"].acquire()
-
     try:
         # Basic data
         group_list = list(glovar.admin_ids)
+        results = Queue()
+        pending = 0
 
-        # Check groups
-        for gid in group_list:
-            group_name, group_link = get_group_info(client, gid)
-            admin_members = get_admins(client, gid)
-
-            # Bot is not in the chat, leave automatically without approve
-            if admin_members is False or any(admin.user.is_self for admin in admin_members) is False:
-                leave_group(client, gid)
-                share_data(
-                    client=client,
-                    receivers=["MANAGE"],
-                    action="leave",
-                    action_type="info",
-                    data={
-                        "group_id": gid,
-                        "group_name": group_name,
-                        "group_link": group_link
-                    }
-                )
-                project_text = general_link(glovar.project_name, glovar.project_link)
-                debug_text = (f"{lang('project')}{lang('colon')}{project_text}\n"
-                              f"{lang('group_name')}{lang('colon')}{general_link(group_name, group_link)}\n"
-                              f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
-                              f"{lang('status')}{lang('colon')}{code(lang('leave_auto'))}\n"
-                              f"{lang('reason')}{lang('colon')}{code(lang('reason_leave'))}\n")
-                thread(send_message, (client, glovar.debug_channel_id, debug_text))
-                continue
+        # Fetch limit_admin groups at a time on the Telegram pool, apply each result as soon as it arrives
+        while group_list or pending:
+            while group_list and pending < glovar.limit_admin:
+                pending += thread(update_admins_fetch, (client, group_list.pop(0), results))
 
-            # Check the admin list
-            if not (admin_members and any([admin.user.is_self for admin in admin_members])):
-                continue
+            if not pending:
+                break
 
-            # Save the admin list
-            save_admins(gid, admin_members)
+            gid, group_name, group_link, admin_members = results.get()
+            pending -= 1
+            update_admins_apply(client, gid, group_name, group_link, admin_members)
 
-            # Ignore the group
-            if gid in glovar.lack_group_ids:
-                continue
+        result = True
+    except Exception as e:
+        logger.warning(f"Update admin error: {e}", exc_info=True)
 
-            # Check the permissions
-            if glovar.user_id not in glovar.admin_ids[gid]:
-                reason = "user"
-            elif any(admin.user.is_self
-                     and admin.can_delete_messages
-                     and admin.can_restrict_members
-                     and admin.can_pin_messages
-                     for admin in admin_members):
-                glovar.lack_group_ids.discard(gid)
-                save("lack_group_ids")
-                continue
-            else:
-                reason = "permissions"
-                glovar.lack_group_ids.add(gid)
-                save("lack_group_ids")
+    return result
+
+
+def update_admins_apply(client: Client, gid: int, group_name: str, group_link: str,
+                        admin_members: Union[bool, List[ChatMember], None]) -> bool:
+    # Apply a group's fetched admin list, the admin lock is only held here
+    result = False
+
+    glovar.locks["admin"].acquire()
+
+    try:
+        # The group was left while fetching
+        if gid not in glovar.admin_ids:
+            return False
 
-            # Send the leave request
+        # Bot is not in the chat, leave automatically without approve
+        if admin_members is False or any(admin.user.is_self for admin in admin_members) is False:
+            leave_group(client, gid)
             share_data(
                 client=client,
                 receivers=["MANAGE"],
                 action="leave",
-                action_type="request",
+                action_type="info",
                 data={
                     "group_id": gid,
                     "group_name": group_name,
-                    "group_link": group_link,
-                    "reason": reason
+                    "group_link": group_link
                 }
             )
-            reason = lang(f"reason_{reason}")
-            project_link = general_link(glovar.project_name, glovar.project_link)
-            debug_text = (f"{lang('project')}{lang('colon')}{project_link}\n"
+            project_text = general_link(glovar.project_name, glovar.project_link)
+            debug_text = (f"{lang('project')}{lang('colon')}{project_text}\n"
                           f"{lang('group_name')}{lang('colon')}{general_link(group_name, group_link)}\n"
                           f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
-                          f"{lang('status')}{lang('colon')}{code(reason)}\n")
-            thread(send_message, (client, glovar.debug_channel_id, debug_text))
+                          f"{lang('status')}{lang('colon')}{code(lang('leave_auto'))}\n"
+                          f"{lang('reason')}{lang('colon')}{code(lang('reason_leave'))}\n")
+            thread(send_message, (client, glovar.debug_channel_id, debug_text), pool="debug")
+            return True
+
+        # Check the admin list
+        if not (admin_members and any([admin.user.is_self for admin in admin_members])):
+            return False
+
+        # Save the admin list
+        save_admins(gid, admin_members)
+
+        # Ignore the group
+        if gid in glovar.lack_group_ids:
+            return True
+
+        # Check the permissions
+        if glovar.user_id not in glovar.admin_ids[gid]:
+            reason = "user"
+        elif any(admin.user.is_self
+                 and admin.can_delete_messages
+                 and admin.can_restrict_members
+                 and admin.can_pin_messages
+                 for admin in admin_members):
+            glovar.lack_group_ids.discard(gid)
+            save("lack_group_ids")
+            return True
+        else:
+            reason = "permissions"
+            glovar.lack_group_ids.add(gid)
+            save("lack_group_ids")
+
+        # Send the leave request
+        share_data(
+            client=client,
+            receivers=["MANAGE"],
+            action="leave",
+            action_type="request",
+            data={
+                "group_id": gid,
+                "group_name": group_name,
+                "group_link": group_link,
+                "reason": reason
+            }
+        )
+        reason = lang(f"reason_{reason}")
+        project_link = general_link(glovar.project_name, glovar.project_link)
+        debug_text = (f"{lang('project')}{lang('colon')}{project_link}\n"
+                      f"{lang('group_name')}{lang('colon')}{general_link(group_name, group_link)}\n"
+                      f"{lang('group_id')}{lang('colon')}{code(gid)}\n"
+                      f"{lang('status')}{lang('colon')}{code(reason)}\n")
+        thread(send_message, (client, glovar.debug_channel_id, debug_text), pool="debug")
 
         result = True
     except Exception as e:
-        logger.warning(f"Update admin error: {e}", exc_info=True)
+        logger.warning(f"Update admins apply error: {e}", exc_info=True)
     finally:
         glovar.locks["admin"].release()
 
     return result
 
 
+def update_admins_fetch(client: Client, gid: int, results: Queue) -> bool:
+    # Fetch a group's info and admin list without holding any lock, put them in the results
+    result = False
+
+    group_name, group_link, admin_members = "Unknown Group", glovar.default_group_link, None
+
+    try:
+        group_name, group_link = get_group_info(client, gid)
+        admin_members = get_admins(client, gid)
+        result = True
+    except Exception as e:
+        logger.warning(f"Update admins fetch error: {e}", exc_info=True)
+    finally:
+        results.put((gid, group_name, group_link, admin_members))
+
+    return result
+
+
 def update_status(client: Client, the_type: str) -> bool:
     # Update running status to BACKUP
     result = False
@@ -17,7 +17,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from time import sleep
+from heapq import heapify, heappop, heappush
+from time import sleep, time
 from typing import Dict, Iterable, Union
 
 from pyrogram import Client
@@ -27,12 +28,12 @@ from pyrogram.raw.types import User
 from .. import glovar
 from .channel import ask_for_help, ask_help_welcome, declare_message, send_debug, share_data, update_score
 from .command import get_command_type
-from .decorators import threaded
-from .etc import code, delay, get_int, get_now, get_readable_time, get_text, lang, mention_text, random_str, thread
+from .decorators import prioritized, threaded
+from .etc import add_delay, code, get_int, get_now, get_readable_time, get_text, lang, mention_text, random_str, thread
 from .file import data_to_file, file_tsv, save
 from .filters import is_class_d_user, is_flooded, is_from_user, is_should_qns
 from .group import delete_hint, delete_message
-from .ids import init_user_id
+from .ids import init_user_id, pop_wait
 from .telegram import answer_callback, edit_message_photo, edit_message_text, get_messages, get_user_full
 from .telegram import kick_chat_member, resolve_username, restrict_chat_member, unban_chat_member
 
@@ -40,6 +41,29 @@ from .telegram import kick_chat_member, resolve_username, restrict_chat_member,
 logger = logging.getLogger(__name__)
 
 
+def add_deadline(uid: int, now: int = 0) -> bool:
+    # Add the next deadline of the user to the deadline index
+    result = False
+
+    try:
+        deadline = get_deadline(uid, now or get_now())
+
+        if not deadline:
+            return False
+
+        with glovar.deadline_condition:
+            heappush(glovar.deadline_heap, (deadline, uid))
+
+            # Wake the deadline thread if this is the earliest deadline
+            glovar.deadline_heap[0] == (deadline, uid) and glovar.deadline_condition.notify()
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Add deadline error: {e}", exc_info=True)
+
+    return result
+
+
 def add_start(until: int, cid: int, uid: int, action: str) -> str:
     # Add start
     result = ""
@@ -66,6 +90,7 @@ def add_start(until: int, cid: int, uid: int, action: str) -> str:
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def ban_user(client: Client, gid: int, uid: Union[int, str], lock: bool = False) -> bool:
     # Ban a user
@@ -111,6 +136,42 @@ def change_member_status(client: Client, level: str, gid: int, uid: int,
     return result
 
 
+def check_deadlines(client: Client, now: int) -> bool:
+    # Check the users whose deadline has passed, instead of every user
+    result = False
+
+    try:
+        uids = set()
+
+        with glovar.locks["deadline"]:
+            while glovar.deadline_heap and glovar.deadline_heap[0][0] <= now:
+                uids.add(heappop(glovar.deadline_heap)[1])
+
+        for uid in uids:
+            if glovar.user_ids.get(uid) is None:
+                continue
+
+            # Remove users from the CAPTCHA group
+            remove_group_user(client, uid, now)
+
+            # Terminate timeout users
+            check_timeout_user(client, uid, now)
+
+            # Lift the ban on users
+            lift_ban(client, uid, now)
+
+            # Schedule the user's next deadline
+            add_deadline(uid, now)
+
+        uids and save("user_ids")
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Check deadlines error: {e}", exc_info=True)
+
+    return result
+
+
 def check_timeout_user(client: Client, uid: int, now: int) -> bool:
     # Check timeout user
     result = False
@@ -166,6 +227,26 @@ def check_timeout_user(client: Client, uid: int, now: int) -> bool:
     return result
 
 
+def deadline_loop(client: Client) -> None:
+    # Check the deadlines as soon as they pass
+    while True:
+        try:
+            with glovar.deadline_condition:
+                if glovar.deadline_heap:
+                    glovar.deadline_condition.wait(max(glovar.deadline_heap[0][0] - time(), 0))
+                else:
+                    glovar.deadline_condition.wait(60)
+
+                if not glovar.deadline_heap or glovar.deadline_heap[0][0] > time():
+                    continue
+
+            with glovar.locks["message"]:
+                check_deadlines(client, get_now())
+        except Exception as e:
+            logger.warning(f"Deadline loop error: {e}", exc_info=True)
+            sleep(1)
+
+
 @threaded()
 def failed_user(client: Client, uid: int, reason: str) -> bool:
     # Log failed user info
@@ -440,6 +521,41 @@ def get_level(gid: int) -> str:
     return result
 
 
+def get_deadline(uid: int, now: int) -> int:
+    # Get the earliest time when the user's wait, CAPTCHA group or failed status expires, 0 if none
+    result = 0
+
+    try:
+        user_status = glovar.user_ids[uid]
+        deadlines = []
+
+        # Wait timeout and qns timeout
+        for gid, deadline in list(user_status["wait"].items()):
+            if not deadline:
+                continue
+
+            if is_should_qns(gid):
+                deadlines.append(deadline + ((glovar.time_captcha // 2) or 30) + 1)
+            else:
+                deadlines.append(deadline + glovar.time_captcha + 1)
+
+        # Removal from the CAPTCHA group
+        user_status["time"] and deadlines.append(user_status["time"] + glovar.time_remove + 1)
+
+        # Ban lift
+        deadlines += [deadline + glovar.time_punish + 1
+                      for deadline in list(user_status["failed"].values()) if deadline > 0]
+
+        # A passed deadline was held back, for example by a flooded group, check it again later
+        deadlines = [deadline if deadline > now else now + 60 for deadline in deadlines]
+
+        result = min(deadlines) if deadlines else 0
+    except Exception as e:
+        logger.warning(f"Get deadline error: {e}", exc_info=True)
+
+    return result
+
+
 def get_uid(client: Client, message: Message) -> int:
     # Get user id from the message
     result = 0
@@ -575,6 +691,32 @@ def get_uid_from_text(message: Message) -> int:
     return result
 
 
+def init_deadlines() -> bool:
+    # Init the deadline index from user records
+    result = False
+
+    try:
+        now = get_now()
+        deadline_heap = []
+
+        for uid in list(glovar.user_ids):
+            deadline = get_deadline(uid, now)
+            deadline and deadline_heap.append((deadline, uid))
+
+        heapify(deadline_heap)
+
+        with glovar.deadline_condition:
+            glovar.deadline_heap = deadline_heap
+            glovar.deadline_condition.notify()
+
+        result = True
+    except Exception as e:
+        logger.warning(f"Init deadlines error: {e}", exc_info=True)
+
+    return result
+
+
+@prioritized("moderation")
 @threaded()
 def kick_user(client: Client, gid: int, uid: Union[int, str], until_date: int = 0, lock: bool = False) -> bool:
     # Kick a user
@@ -599,6 +741,7 @@ def kick_user(client: Client, gid: int, uid: Union[int, str], until_date: int =
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def kick_users(client: Client, gid: int, uids: Iterable[int]) -> bool:
     # Kick users
@@ -756,7 +899,7 @@ def remove_new_users() -> bool:
 
     try:
         for uid in list(glovar.user_ids):
-            glovar.user_ids[uid]["join"] = {}
+            glovar.user_ids[uid]["join"] and glovar.user_ids[uid]["join"].clear()
 
         result = True
     except Exception as e:
@@ -788,8 +931,8 @@ def remove_wait_user(client: Client, uid: int) -> bool:
                 continue
 
             level = get_level(gid)
-            delay(3, change_member_status, [client, level, gid, uid, True])
-            glovar.user_ids[uid]["wait"].pop(gid, 0)
+            add_delay(3, "change_member_status", [level, gid, uid, True])
+            pop_wait(uid, gid)
             glovar.user_ids[uid]["qns"].pop(gid, "")
             glovar.user_ids[uid]["manual"].discard(gid)
             glovar.user_ids[uid]["failed"][gid] = 0
@@ -817,7 +960,7 @@ def remove_wait_user(client: Client, uid: int) -> bool:
         save("user_ids")
 
         # Remove from CAPTCHA group
-        delay(10, remove_captcha_group, [client, uid])
+        add_delay(10, "remove_captcha_group", [uid])
 
         if not mid:
             return True
@@ -850,6 +993,7 @@ def remove_wait_user(client: Client, uid: int) -> bool:
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def restrict_user(client: Client, gid: int, uid: Union[int, str], until_date: int = 0) -> bool:
     # Restrict a user
@@ -872,7 +1016,7 @@ def terminate_user_banned(client: Client, uid: int, gid: int) -> bool:
 
     try:
         # Check the user's status in that group
-        failed = glovar.user_ids[uid]["wait"].pop(gid, 0)
+        failed = pop_wait(uid, gid)
         glovar.user_ids[uid]["qns"].pop(gid, "")
         glovar.user_ids[uid]["manual"].discard(gid)
 
@@ -918,7 +1062,7 @@ def terminate_user_banned(client: Client, uid: int, gid: int) -> bool:
         save("user_ids")
 
         # Remove from CAPTCHA group
-        delay(10, remove_captcha_group, [client, uid])
+        add_delay(10, "remove_captcha_group", [uid])
 
         result = failed_user(client, uid, "banned")
     except Exception as e:
@@ -955,7 +1099,7 @@ def terminate_user_pass(client: Client, uid: int, gid: int, aid: int) -> bool:
 
         # Modify the status
         glovar.user_ids[uid]["pass"][gid] = now
-        waiting = glovar.user_ids[uid]["wait"].pop(gid, 0)
+        waiting = pop_wait(uid, gid)
         glovar.user_ids[uid]["qns"].pop(gid, "")
         glovar.user_ids[uid]["failed"].pop(gid, 0)
         glovar.user_ids[uid]["banned"].discard(gid)
@@ -1025,7 +1169,7 @@ def terminate_user_pass(client: Client, uid: int, gid: int, aid: int) -> bool:
         save("user_ids")
 
         # Remove from CAPTCHA group
-        delay(10, remove_captcha_group, [client, uid])
+        add_delay(10, "remove_captcha_group", [uid])
 
         result = True
     except Exception as e:
@@ -1107,14 +1251,14 @@ def terminate_user_succeed(client: Client, uid: int) -> bool:
 
         if glovar.user_ids[uid]["wait"]:
             gid = min(glovar.user_ids[uid]["wait"], key=glovar.user_ids[uid]["wait"].get)
-            [glovar.user_ids[uid]["wait"].pop(g, 0) for g in wait_group_list]
+            [pop_wait(uid, g) for g in wait_group_list]
             glovar.user_ids[uid]["succeeded"][gid] = now
 
         # Delete the hint
         not all(is_flooded(gid) for gid in wait_group_list) and delete_hint(client)
 
         # Remove from CAPTCHA group
-        delay(60, remove_captcha_group, [client, uid])
+        add_delay(60, "remove_captcha_group", [uid])
 
         # Ask help welcome
         welcome_ids = [wid for wid in wait_group_list if wid not in glovar.user_ids[uid]["manual"]]
@@ -1202,7 +1346,7 @@ def terminate_user_succeed_qns(client: Client, gid: int, uid: int, qid: str) ->
         unrestrict_user(client, gid, uid)
 
         # Modify the status
-        glovar.user_ids[uid]["wait"].pop(gid, 0)
+        pop_wait(uid, gid)
         glovar.user_ids[uid]["failed"].pop(gid, 0)
         glovar.user_ids[uid]["restricted"].discard(gid)
         glovar.user_ids[uid]["banned"].discard(gid)
@@ -1267,7 +1411,7 @@ def terminate_user_timeout(client: Client, uid: int) -> bool:
             not is_flooded(gid) and ask_for_help(client, "delete", gid, uid)
 
             # Modify the status
-            glovar.user_ids[uid]["wait"].pop(gid, 0)
+            pop_wait(uid, gid)
             glovar.user_ids[uid]["manual"].discard(gid)
 
             if glovar.user_ids[uid]["succeeded"].get(gid, 0):
@@ -1278,6 +1422,7 @@ def terminate_user_timeout(client: Client, uid: int) -> bool:
                 glovar.user_ids[uid]["failed"][gid] = 0
             else:
                 glovar.user_ids[uid]["failed"][gid] = now
+                add_deadline(uid, now)
 
             # Flood log
             is_flooded(gid) and flood_user(gid, uid, now, level, "timeout")
@@ -1301,7 +1446,7 @@ def terminate_user_timeout(client: Client, uid: int) -> bool:
         save("user_ids")
 
         # Remove from CAPTCHA group
-        delay(10, remove_captcha_group, [client, uid])
+        add_delay(10, "remove_captcha_group", [uid])
 
         # Update the score
         not any(is_flooded(gid) for gid in wait_group_list) and update_score(client, uid)
@@ -1347,7 +1492,7 @@ def terminate_user_timeout_qns(client: Client, gid: int, uid: int) -> bool:
         now = get_now()
 
         # Modify the status
-        glovar.user_ids[uid]["wait"].pop(gid, 0)
+        pop_wait(uid, gid)
         glovar.user_ids[uid]["qns"].pop(gid, "")
         glovar.user_ids[uid]["manual"].discard(gid)
         glovar.user_ids[uid]["restricted"].discard(gid)
@@ -1376,6 +1521,7 @@ def terminate_user_timeout_qns(client: Client, gid: int, uid: int) -> bool:
             glovar.user_ids[uid]["failed"][gid] = 0
         else:
             glovar.user_ids[uid]["failed"][gid] = now
+            add_deadline(uid, now)
 
         # Delete all messages from the user
         not is_flooded(gid) and ask_for_help(client, "delete", gid, uid)
@@ -1453,11 +1599,12 @@ def terminate_user_wrong(client: Client, uid: int) -> bool:
             not is_flooded(gid) and ask_for_help(client, "delete", gid, uid)
 
             # Modify the status
-            glovar.user_ids[uid]["wait"].pop(gid, 0)
+            pop_wait(uid, gid)
             glovar.user_ids[uid]["manual"].discard(gid)
 
             # Give the user one more chance
             glovar.user_ids[uid]["failed"][gid] = now
+            add_deadline(uid, now)
             glovar.user_ids[uid]["restricted"].discard(gid)
             glovar.user_ids[uid]["banned"].discard(gid)
 
@@ -1476,7 +1623,7 @@ def terminate_user_wrong(client: Client, uid: int) -> bool:
         not all(is_flooded(gid) for gid in wait_group_list) and delete_hint(client)
 
         # Remove from CAPTCHA group
-        delay(15, remove_captcha_group, [client, uid])
+        add_delay(15, "remove_captcha_group", [uid])
 
         # Update the score
         not any(is_flooded(gid) for gid in wait_group_list) and update_score(client, uid)
@@ -1535,7 +1682,7 @@ def terminate_user_wrong_qns(client: Client, gid: int, uid: int, qid: str) -> bo
         now = get_now()
 
         # Modify the status
-        glovar.user_ids[uid]["wait"].pop(gid, 0)
+        pop_wait(uid, gid)
         glovar.user_ids[uid]["qns"].pop(gid, "")
         glovar.user_ids[uid]["manual"].discard(gid)
         glovar.user_ids[uid]["restricted"].discard(gid)
@@ -1570,6 +1717,7 @@ def terminate_user_wrong_qns(client: Client, gid: int, uid: int, qid: str) -> bo
             glovar.user_ids[uid]["failed"][gid] = 0
         else:
             glovar.user_ids[uid]["failed"][gid] = now
+            add_deadline(uid, now)
 
         # Delete all messages from the user
         not is_flooded(gid) and ask_for_help(client, "delete", gid, uid)
@@ -1603,6 +1751,7 @@ def terminate_user_wrong_qns(client: Client, gid: int, uid: int, qid: str) -> bo
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def unban_user(client: Client, gid: int, uid: int, lock: bool = False) -> bool:
     # Unban a user
@@ -1620,6 +1769,7 @@ def unban_user(client: Client, gid: int, uid: int, lock: bool = False) -> bool:
     return result
 
 
+@prioritized("moderation")
 @threaded()
 def unrestrict_user(client: Client, gid: int, uid: Union[int, str], lock: bool = False) -> bool:
     # Unrestrict a user
@@ -17,22 +17,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
 from codecs import getdecoder
+from concurrent.futures import ThreadPoolExecutor
 from configparser import RawConfigParser
 from glob import glob
-from os import mkdir
+from os import mkdir, remove, rename
 from os.path import exists
 from shutil import rmtree
 from string import ascii_lowercase
-from threading import Lock
-from typing import Dict, List, Set, Union
+from threading import Condition, Lock
+from time import time
+from typing import Any, Dict, List, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI
 from pyrogram.types import Chat
 from yaml import safe_load
 
 from .checker import check_all
+from .locks import RWLock, StripedLock, TimedLock
+from .pools import BoundedPool, CoroutinePool
+from .rates import RateLimiter
+from .records import JoinHistory, UserStatus
+from .storage import UserStore, get_digest, get_shard_paths, load_shards, loads_data, migrate, read_data
+from .storage import replay_journal, write_data
 
 # Enable logging
 logging.basicConfig(
@@ -112,26 +119,41 @@ lang: str = "cmn-Hans"
 normalize: Union[bool, str] = "True"
 
 # [limit]
+limit_admin: int = 4
+limit_chat: int = 20
 limit_flood: int = 10
+limit_join: int = 6
 limit_mention: int = 20
+limit_pool: int = 16
+limit_rate: int = 25
+limit_shard: int = 1
 limit_track: int = 8
 limit_try: int = 2
 
 # [mode]
 aio: Union[bool, str] = "False"
 backup: Union[bool, str] = "False"
+coroutine: Union[bool, str] = "False"
 failed: Union[bool, str] = "False"
+journal: Union[bool, str] = "False"
+lazy: Union[bool, str] = "False"
+marshal: Union[bool, str] = "False"
 simple: Union[bool, str] = "False"
 simple_only: Union[bool, str] = "False"
+sqlite: Union[bool, str] = "False"
 
 # [time]
 date_reset: str = "1st mon"
 time_captcha: int = 240
+time_idle: int = 2592000
 time_invite: int = 1800
+time_join: int = 20
+time_keep: int = 7776000
 time_new: int = 1800
 time_punish: int = 600
 time_recheck: int = 3600
 time_remove: int = 300
+time_save: int = 5
 time_short: int = 300
 time_track: int = 3600
 
@@ -207,8 +229,14 @@ try:
     normalize = eval(normalize)
 
     # [limit]
+    limit_admin = int(config.get("limit", "limit_admin", fallback=limit_admin))
+    limit_chat = int(config.get("limit", "limit_chat", fallback=limit_chat))
     limit_flood = int(config.get("limit", "limit_flood", fallback=limit_flood))
+    limit_join = int(config.get("limit", "limit_join", fallback=limit_join))
     limit_mention = int(config.get("limit", "limit_mention", fallback=limit_mention))
+    limit_pool = int(config.get("limit", "limit_pool", fallback=limit_pool))
+    limit_rate = int(config.get("limit", "limit_rate", fallback=limit_rate))
+    limit_shard = int(config.get("limit", "limit_shard", fallback=limit_shard))
     limit_track = int(config.get("limit", "limit_track", fallback=limit_track))
     limit_try = int(config.get("limit", "limit_try", fallback=limit_try))
 
@@ -217,21 +245,35 @@ try:
     aio = eval(aio)
     backup = config.get("mode", "backup", fallback=backup)
     backup = eval(backup)
+    coroutine = config.get("mode", "coroutine", fallback=coroutine)
+    coroutine = eval(coroutine)
     failed = config.get("mode", "failed", fallback=failed)
     failed = eval(failed)
+    journal = config.get("mode", "journal", fallback=journal)
+    journal = eval(journal)
+    lazy = config.get("mode", "lazy", fallback=lazy)
+    lazy = eval(lazy)
+    marshal = config.get("mode", "marshal", fallback=marshal)
+    marshal = eval(marshal)
     simple = config.get("mode", "simple", fallback=simple)
     simple = eval(simple)
     simple_only = config.get("mode", "simple_only", fallback=simple_only)
     simple_only = eval(simple_only)
+    sqlite = config.get("mode", "sqlite", fallback=sqlite)
+    sqlite = eval(sqlite)
 
     # [time]
     date_reset = config.get("time", "date_reset", fallback=date_reset)
     time_captcha = int(config.get("time", "time_captcha", fallback=time_captcha))
+    time_idle = int(config.get("time", "time_idle", fallback=time_idle))
     time_invite = int(config.get("time", "time_invite", fallback=time_invite))
+    time_join = int(config.get("time", "time_join", fallback=time_join))
+    time_keep = int(config.get("time", "time_keep", fallback=time_keep))
     time_new = int(config.get("time", "time_new", fallback=time_new))
     time_punish = int(config.get("time", "time_punish", fallback=time_punish))
     time_recheck = int(config.get("time", "time_recheck", fallback=time_recheck))
     time_remove = int(config.get("time", "time_remove", fallback=time_remove))
+    time_save = int(config.get("time", "time_save", fallback=time_save))
     time_short = int(config.get("time", "time_short", fallback=time_short))
     time_track = int(config.get("time", "time_track", fallback=time_track))
 
@@ -303,26 +345,41 @@ check_all(
             "normalize": normalize
         },
         "limit": {
+            "limit_admin": limit_admin,
+            "limit_chat": limit_chat,
             "limit_flood": limit_flood,
+            "limit_join": limit_join,
             "limit_mention": limit_mention,
+            "limit_pool": limit_pool,
+            "limit_rate": limit_rate,
+            "limit_shard": limit_shard,
             "limit_track": limit_track,
             "limit_try": limit_try
         },
         "mode": {
             "aio": aio,
             "backup": backup,
+            "coroutine": coroutine,
             "failed": failed,
+            "journal": journal,
+            "lazy": lazy,
+            "marshal": marshal,
             "simple": simple,
-            "simple_only": simple_only
+            "simple_only": simple_only,
+            "sqlite": sqlite
         },
         "time": {
             "date_reset": date_reset,
             "time_captcha": time_captcha,
+            "time_idle": time_idle,
             "time_invite": time_invite,
+            "time_join": time_join,
+            "time_keep": time_keep,
             "time_new": time_new,
             "time_punish": time_punish,
             "time_recheck": time_recheck,
             "time_remove": time_remove,
+            "time_save": time_save,
             "time_short": time_short,
             "time_track": time_track
         }
@@ -357,6 +414,7 @@ all_commands: List[str] = [
     "show",
     "start",
     "static",
+    "status",
     "version"
 ]
 
@@ -451,21 +509,140 @@ default_user_status: Dict[str, Union[int, str, Dict[Union[int, str], Union[float
     }
 }
 
+deadline_heap: List[Tuple[int, int]] = []
+# deadline_heap = [
+#     (1512345678, 12345678)
+# ]
+
+delay_heap: List[Tuple[float, str]] = []
+# delay_heap = [
+#     (1512345678.0, "a1b2c3d4")
+# ]
+
+delay_stats: Dict[str, float] = {
+    "added": 0,
+    "dispatched": 0,
+    "lag": 0.0,
+    "max": 0.0
+}
+
+dirty_files: Dict[str, float] = {}
+# dirty_files = {
+#     "user_ids": 1512345678.0
+# }
+
+emoji_time: float = time()
 emoji_set: Set[str] = set(UNICODE_EMOJI)
+emoji_time = time() - emoji_time
+
+expiry_heap: List[Tuple[int, str, int]] = []
+# expiry_heap = [
+#     (1512345678, "user", 12345678),
+#     (1512345678, "ban", 12345678)
+# ]
+
+hint_heap: List[Tuple[int, int]] = []
+# hint_heap = [
+#     (1512345678, -10012345678)
+# ]
+
+hint_ids: Set[int] = set()
+# hint_ids = {-10012345678}
+
+job_buckets: List[int] = [1, 10, 60, 300, 1800]
+
+job_names: Dict[str, str] = {}
+# job_names = {
+#     "job_id": "interval_min_01"
+# }
+
+job_stats: Dict[str, Dict[str, Union[float, int, List[int]]]] = {}
+# job_stats = {
+#     "interval_min_01": {
+#         "runs": 0,
+#         "failed": 0,
+#         "missed": 0,
+#         "skipped": 0,
+#         "buckets": [0, 0, 0, 0, 0, 0],
+#         "total": 0.0,
+#         "max": 0.0,
+#         "lock": 0.0,
+#         "last": 0
+#     }
+# }
+
+join_rates: Dict[int, Tuple[float, int]] = {}
+# join_rates = {
+#     -10012345678: (12.5, 1512345678)
+# }
+
+journal_digests: Dict[str, Dict[Any, bytes]] = {}
+# journal_digests = {
+#     "user_ids": {
+#         12345678: b"digest"
+#     }
+# }
+
+# The locks of the conditions stay plain
+locks: Dict[str, Union[Lock, RWLock, TimedLock]] = {
+    "admin": TimedLock(),
+    "ban": TimedLock(),
+    "config": TimedLock(),
+    "deadline": Lock(),
+    "delay": Lock(),
+    "failed": TimedLock(),
+    "flood": TimedLock(),
+    "hint": TimedLock(),
+    "invite": TimedLock(),
+    "lazy": TimedLock(),
+    "message": RWLock(),
+    "pin": TimedLock(),
+    "receive": TimedLock(),
+    "regex": TimedLock(),
+    "save": TimedLock(),
+    "trust": TimedLock()
+}
+
+# Stripes under the shared message lock, see lock_message
+group_locks: StripedLock = StripedLock()
+user_locks: StripedLock = StripedLock()
+
+# Wakes the deadline thread when an earlier deadline is added
+deadline_condition: Condition = Condition(locks["deadline"])
+
+# Wakes the delay thread when an action is added
+delay_condition: Condition = Condition(locks["delay"])
 
-locks: Dict[str, Lock] = {
-    "admin": Lock(),
-    "ban": Lock(),
-    "config": Lock(),
-    "failed": Lock(),
-    "flood": Lock(),
-    "invite": Lock(),
-    "message": Lock(),
-    "pin": Lock(),
-    "receive": Lock(),
-    "regex": Lock()
+# Background calls, a full queue makes Telegram and file calls wait up to 5 seconds for a slot, then keeps them in an
+# overflow list, a thread holding a lock does not wait, debug calls are dropped
+# In coroutine mode, Telegram calls with an async variant are awaited on the event loop of the client
+pools: Dict[str, Union[BoundedPool, CoroutinePool]] = {
+    "coroutine": CoroutinePool("coroutine", 1000),
+    "debug": BoundedPool("debug", 2, 200, "drop"),
+    "file": BoundedPool("file", 2, 100, "block"),
+    "telegram": BoundedPool("telegram", limit_pool, 1000, "block")
 }
 
+# API budgets, limit_rate calls per second for the bot and limit_chat calls per minute for each chat
+limiter: RateLimiter = RateLimiter(limit_rate, limit_rate, limit_chat / 60, limit_chat)
+
+# Priority classes of API calls, highest first, a call outside of any class is a moderation call
+# A class only takes budget while the wait is within its hold in seconds, -1 means no hold
+# Above the hold, calls of a dropped class are shed, the others are deferred until the backlog drains
+priorities: List[str] = ["captcha", "moderation", "share", "debug"]
+priority_drops: Set[str] = {"debug"}
+priority_holds: Dict[str, float] = {
+    "captcha": -1,
+    "moderation": 0.5,
+    "share": 0.2,
+    "debug": 0.1
+}
+
+memory_sizes: Dict[str, int] = {}
+# memory_sizes = {
+#     "user_ids": 12345678
+# }
+
 pass_counts: Dict[int, int] = {}
 # pass_counts = {
 #     -10012345678: 0
@@ -521,13 +698,49 @@ regex: Dict[str, bool] = {
 for c in ascii_lowercase:
     regex[f"ad{c}"] = False
 
+save_stats: Dict[str, Union[float, int, Dict[str, float]]] = {
+    "requested": 0,
+    "flushed": 0,
+    "journal": 0,
+    "shards": 0,
+    "latency": 0.0,
+    "max": 0.0,
+    "time": 0.0,
+    "last": {}
+}
+# save_stats = {
+#     "requested": 120,
+#     "flushed": 12,
+#     "journal": 30,
+#     "shards": 3,
+#     "latency": 30.5,
+#     "max": 5.2,
+#     "time": 1.2,
+#     "last": {
+#         "user_ids": 1512345678.0
+#     }
+# }
+
 sender: str = "CAPTCHA"
 
+shard_sizes: Dict[str, Dict[int, int]] = {}
+# shard_sizes = {
+#     "user_ids": {
+#         0: 1024
+#     }
+# }
+
 should_hide: bool = False
 
 started_ids: Set[int] = set()
 # started_ids = {12345678}
 
+# Count of groups that trust each user
+trusted_ids: Dict[int, int] = {}
+# trusted_ids = {
+#     12345678: 1
+# }
+
 usernames: Dict[str, Dict[str, Union[int, str]]] = {}
 # usernames = {
 #     "SCP_079": {
@@ -536,6 +749,11 @@ usernames: Dict[str, Dict[str, Union[int, str]]] = {}
 #     }
 # }
 
+wait_ids: Dict[int, Set[int]] = {}
+# wait_ids = {
+#     -10012345678: {12345678}
+# }
+
 version: str = "0.6.8"
 
 # Load data from pics database
@@ -736,6 +954,11 @@ white_ids: Set[int] = set()
 
 # Init data variables
 
+backup_manifest: Dict[str, str] = {}
+# backup_manifest = {
+#     "user_ids": "hash"
+# }
+
 configs: Dict[int, Dict[str, Union[bool, int]]] = {}
 # configs = {
 #     -10012345678: {
@@ -765,6 +988,15 @@ custom_texts: Dict[int, Dict[str, str]] = {}
 #     }
 # }
 
+delays: Dict[str, Dict[str, Union[float, str, list]]] = {}
+# delays = {
+#     "a1b2c3d4": {
+#         "time": 1512345678.0,
+#         "action": "remove_captcha_group",
+#         "args": [12345678]
+#     }
+# }
+
 flood_logs: Dict[int, List[Dict[str, Union[int, str]]]] = {}
 # flood_logs = {
 #     -10012345678: [
@@ -834,30 +1066,153 @@ for word_type in regex:
 file_list: List[str] = ["admin_ids", "bad_ids", "failed_ids", "flooded_ids", "ignore_ids", "lack_group_ids",
                         "left_group_ids", "message_ids", "pinned_ids", "trust_ids", "user_ids", "watch_ids",
                         "white_ids",
-                        "configs", "custom_texts", "flood_logs", "invite", "questions", "reset_time", "starts",
-                        "token"]
+                        "backup_manifest", "configs", "custom_texts", "delays", "flood_logs", "invite", "questions",
+                        "reset_time", "starts", "token"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
+load_times: Dict[str, float] = {"emoji_set": emoji_time}
+# load_times = {
+#     "user_ids": 1.5
+# }
+
+# Rarely used variables are loaded on first access in lazy mode
+if lazy:
+    lazy_list: List[str] = ["failed_ids", "flood_logs"]
+    lazy_list += [f"{f}_words" for f in regex if f not in {"spc", "spe"}]
+else:
+    lazy_list: List[str] = []
+
+
+def load_data(file: str, data: Any) -> Any:
+    # Load a global variable from its file, the data is the default value
+    start = time()
+
+    # Merge the shard files
+    try:
+        if get_shard_paths(file):
+            data = load_shards(file)
+
+        if get_shard_paths(file) and limit_shard == 1:
+            with open(f"data/{file}", "wb") as f:
+                write_data(data, f, marshal)
+
+            for path in get_shard_paths(file).values():
+                remove(path)
+
+        if get_shard_paths(file):
+            load_times[file] = time() - start
+            return data
+    except Exception as e:
+        logger.critical(f"Load data {file} shards error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+    # Digest of the loaded snapshot, a journal written before a newer snapshot is skipped
+    base = None
+
     try:
         try:
             if exists(f"data/{file}") or exists(f"data/.{file}"):
                 with open(f"data/{file}", "rb") as f:
-                    locals()[f"{file}"] = pickle.load(f)
+                    blob = f.read()
+                    data = loads_data(blob)
+                    base = get_digest(blob)
             else:
                 with open(f"data/{file}", "wb") as f:
-                    pickle.dump(eval(f"{file}"), f)
+                    write_data(data, f, marshal)
         except Exception as e:
             logger.error(f"Load data {file} error: {e}", exc_info=True)
 
             with open(f"data/.{file}", "rb") as f:
-                locals()[f"{file}"] = pickle.load(f)
+                data = read_data(f)
     except Exception as e:
         logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
         raise SystemExit("[DATA CORRUPTION]")
 
+    # Replay the journal
+    try:
+        if exists(f"data/{file}.journal"):
+            replay_journal(data, f"data/{file}.journal", base)
+
+        if exists(f"data/{file}.journal") and not journal:
+            with open(f"data/{file}", "wb") as f:
+                write_data(data, f, marshal)
+
+            remove(f"data/{file}.journal")
+    except Exception as e:
+        logger.critical(f"Replay journal {file} error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+    load_times[file] = time() - start
+
+    return data
+
+
+load_time: float = time()
+load_list: List[str] = [file for file in file_list
+                        if file not in lazy_list and not (sqlite and file == "user_ids"
+                                                          and exists("data/user_ids.db"))]
+
+if lazy:
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for file, file_data in zip(load_list, executor.map(load_data, load_list, [eval(f) for f in load_list])):
+            locals()[f"{file}"] = file_data
+else:
+    for file in load_list:
+        locals()[f"{file}"] = load_data(file, eval(f"{file}"))
+
+lazy_defaults: Dict[str, Any] = {}
+
+for file in lazy_list:
+    lazy_defaults[file] = locals().pop(f"{file}")
+
+
+def __getattr__(name: str) -> Any:
+    # Load a lazy global variable on first access
+    if name not in lazy_defaults:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    with locks["lazy"]:
+        if name not in globals():
+            globals()[name] = load_data(name, lazy_defaults[name])
+
+    return globals()[name]
+
+
+# Open the user status database
+try:
+    start_time = time()
+
+    if sqlite:
+        user_ids = migrate(user_ids, "data/user_ids.db")
+    elif exists("data/user_ids.db"):
+        user_store = UserStore("data/user_ids.db")
+        user_ids = dict(user_store.records)
+        user_store.close()
+
+        with open("data/user_ids", "wb") as f:
+            write_data(user_ids, f, marshal)
+
+        rename("data/user_ids.db", "data/user_ids.db.old")
+
+    sqlite and load_times.update({"user_ids.db": time() - start_time})
+except Exception as e:
+    logger.critical(f"Load user status database error: {e}", exc_info=True)
+    raise SystemExit("[DATA CORRUPTION]")
+
+# Use compact user status records
+start_time = time()
+JoinHistory.capacity = max(JoinHistory.capacity, limit_track)
+user_records = user_ids.records if isinstance(user_ids, UserStore) else user_ids
+
+for uid in user_records:
+    user_records[uid] = UserStatus.from_dict(user_records[uid])
+    user_records[uid].dirty_ = False
+
+load_times["user_records"] = time() - start_time
+
 # Generate special characters dictionary
 for special in ["spc", "spe"]:
+    start_time = time()
     locals()[f"{special}_dict"]: Dict[str, str] = {}
 
     for rule in locals()[f"{special}_words"]:
@@ -875,6 +1230,13 @@ for special in ["spc", "spe"]:
         for k in keys:
             locals()[f"{special}_dict"][k] = value
 
+    load_times[f"{special}_dict"] = time() - start_time
+
+# Report the loading time
+logger.warning(f"Data loaded in {round(time() - load_time, 2)}s, slowest: "
+               + ", ".join(f"{f} {round(load_times[f], 2)}s"
+                           for f in sorted(load_times, key=lambda x: load_times[x], reverse=True)[:5]))
+
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
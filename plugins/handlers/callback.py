@@ -27,6 +27,7 @@ from ..functions.challenge import get_answer, question_answer, question_answer_q
 from ..functions.etc import get_int, get_now, get_text, lang, thread
 from ..functions.filters import authorized_group, captcha_group, from_user, is_class_e_user, test_group
 from ..functions.group import delete_message
+from ..functions.ids import lock_message, unlock_message
 from ..functions.telegram import answer_callback, edit_message_reply_markup
 
 # Enable logging
@@ -122,7 +123,7 @@ def question(client: Client, callback_query: CallbackQuery) -> bool:
     # Answer the question query
     result = False
 
-    glovar.locks["message"].acquire()
+    held = lock_message(uids=[callback_query.from_user.id], waiting=True)
 
     try:
         # Check the message
@@ -170,6 +171,6 @@ def question(client: Client, callback_query: CallbackQuery) -> bool:
     except Exception as e:
         logger.warning(f"Question error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        unlock_message(held)
 
     return result
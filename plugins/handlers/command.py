@@ -32,8 +32,9 @@ from ..functions.command import get_command_type
 from ..functions.config import conflict_config, get_config_text, qns_add, qns_remove, qns_show, start_qns
 from ..functions.config import update_config
 from ..functions.etc import code, code_block, general_link, get_int, get_now, get_readable_time, lang, mention_id
-from ..functions.etc import message_link, random_str, thread
-from ..functions.file import save
+from ..functions.etc import get_job_text, get_memory_status, get_memory_text, get_pool_text, message_link, random_str
+from ..functions.etc import thread
+from ..functions.file import get_save_status, save
 from ..functions.filters import (authorized_group, captcha_group, class_e, from_user, is_class_c, is_class_e,
                                  is_class_e_user, is_from_user, is_flooded, is_should_qns, test_group)
 from ..functions.group import delete_message
@@ -244,7 +245,7 @@ def config(client: Client, message: Message) -> bool:
         if result:
             text += f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n"
 
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -606,7 +607,7 @@ def pass_captcha(client: Client, message: Message) -> bool:
                 f"{lang('admin')}{lang('colon')}{code(aid)}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('action_pass'))}\n"
                 f"{lang('user_id')}{lang('colon')}{code(uid)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -773,7 +774,7 @@ def qns(client: Client, message: Message) -> bool:
         text += (f"{lang('admin_group')}{lang('colon')}{code(message.from_user.id)}\n"
                  f"{lang('action')}{lang('colon')}{code(lang('config_create'))}\n"
                  f"{lang('evidence')}{lang('colon')}{general_link(result.message_id, message_link(result))}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -980,6 +981,92 @@ def static(client: Client, message: Message) -> bool:
     return result
 
 
+@Client.on_message(filters.incoming & filters.group & filters.command(["status"], glovar.prefix)
+                   & test_group
+                   & from_user)
+def status(client: Client, message: Message) -> bool:
+    # Check the program's running status
+    result = False
+
+    try:
+        # Basic data
+        cid = message.chat.id
+        aid = message.from_user.id
+        mid = message.message_id
+
+        # Get command type
+        command_type = get_command_type(message) or "save"
+
+        # Generate the text
+        text = (f"{lang('admin')}{lang('colon')}{mention_id(aid)}\n\n"
+                f"{lang('project')}{lang('colon')}{code(glovar.sender)}\n")
+
+        if command_type == "save":
+            save_status = get_save_status()
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_save'))}\n"
+                     f"{lang('save_requested')}{lang('colon')}{code(save_status['requested'])}\n"
+                     f"{lang('save_flushed')}{lang('colon')}{code(save_status['flushed'])}\n"
+                     f"{lang('save_pending')}{lang('colon')}{code(save_status['pending'])}\n"
+                     f"{lang('save_journal')}{lang('colon')}{code(save_status['journal'])}\n"
+                     f"{lang('save_shards')}{lang('colon')}{code(save_status['shards'])}\n"
+                     f"{lang('save_ratio')}{lang('colon')}{code(save_status['ratio'])}\n"
+                     f"{lang('save_latency')}{lang('colon')}"
+                     f"{code(str(save_status['latency']) + ' ' + lang('seconds'))}\n"
+                     f"{lang('save_max')}{lang('colon')}{code(str(save_status['max']) + ' ' + lang('seconds'))}\n"
+                     f"{lang('save_time')}{lang('colon')}{code(str(save_status['time']) + ' ' + lang('seconds'))}\n")
+        elif command_type == "load":
+            files = sorted(glovar.load_times, key=lambda f: glovar.load_times[f], reverse=True)
+            lazy_count = len([f for f in glovar.lazy_defaults if f not in vars(glovar)])
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_load'))}\n"
+                     f"{lang('load_lazy')}{lang('colon')}{code(lazy_count)}\n")
+            text += "".join(f"{code(f)}{lang('colon')}"
+                            f"{code(str(round(glovar.load_times[f], 3)) + ' ' + lang('seconds'))}\n"
+                            for f in files[:10])
+        elif command_type == "memory":
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_memory'))}\n"
+                     f"{get_memory_text(get_memory_status(), 15)}")
+        elif command_type == "delay":
+            dispatched = glovar.delay_stats["dispatched"]
+            lag = round(glovar.delay_stats["lag"] / dispatched, 3) if dispatched else 0.0
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_delay'))}\n"
+                     f"{lang('delay_depth')}{lang('colon')}{code(len(glovar.delays))}\n"
+                     f"{lang('delay_dispatched')}{lang('colon')}{code(dispatched)}\n"
+                     f"{lang('delay_lag')}{lang('colon')}{code(str(lag) + ' ' + lang('seconds'))}\n"
+                     f"{lang('delay_max')}{lang('colon')}"
+                     f"{code(str(round(glovar.delay_stats['max'], 3)) + ' ' + lang('seconds'))}\n")
+        elif command_type == "jobs":
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_jobs'))}\n"
+                     f"{get_job_text()}")
+        elif command_type == "pools":
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_pools'))}\n"
+                     f"{get_pool_text()}")
+        elif command_type == "rate":
+            rate_status = glovar.limiter.get_status()
+            text += (f"{lang('action')}{lang('colon')}{code(lang('status_rate'))}\n"
+                     f"{lang('rate_calls')}{lang('colon')}{code(rate_status['calls'])}\n"
+                     f"{lang('rate_delayed')}{lang('colon')}{code(rate_status['delayed'])}\n"
+                     f"{lang('rate_wait')}{lang('colon')}{code(str(rate_status['wait']) + ' ' + lang('seconds'))}\n"
+                     f"{lang('rate_max')}{lang('colon')}{code(str(rate_status['max']) + ' ' + lang('seconds'))}\n"
+                     f"{lang('rate_shed')}{lang('colon')}{code(rate_status['shed'])}\n"
+                     f"{lang('rate_flood')}{lang('colon')}{code(rate_status['floods'])}\n"
+                     f"{lang('rate_flood_time')}{lang('colon')}"
+                     f"{code(str(rate_status['flood_time']) + ' ' + lang('seconds'))}\n"
+                     f"{lang('rate_chats')}{lang('colon')}{code(rate_status['chats'])}\n")
+            text += f"{lang('memory_format')}{lang('colon')}{code(lang('rate_columns'))}\n"
+            text += "".join(f"{code(level)}{lang('colon')}"
+                            f"{code(' / '.join(str(v) for v in glovar.limiter.levels[level].values()))}\n"
+                            for level in glovar.priorities if level in glovar.limiter.levels)
+        else:
+            return False
+
+        # Send the report message
+        result = send_message(client, cid, text, mid)
+    except Exception as e:
+        logger.warning(f"Status error: {e}", exc_info=True)
+
+    return result
+
+
 @Client.on_message(filters.incoming & filters.group & filters.command(["version"], glovar.prefix)
                    & test_group
                    & from_user)
@@ -31,7 +31,7 @@ from ..functions.filters import aio, authorized_group, captcha_group, class_c, c
 from ..functions.filters import exchange_channel, from_user, hide_channel, is_class_d_user, is_class_e_user
 from ..functions.filters import is_flooded, is_should_qns, new_group, test_group
 from ..functions.group import delete_message, save_admins, leave_group
-from ..functions.ids import init_group_id
+from ..functions.ids import add_join, init_group_id, lock_message, unlock_message
 from ..functions.receive import receive_add_bad, receive_check_log, receive_clear_data, receive_config_commit
 from ..functions.receive import receive_config_reply, receive_config_show, receive_declared_message
 from ..functions.receive import receive_flood_check, receive_help_captcha, receive_help_confirm
@@ -55,7 +55,7 @@ def hint(client: Client, message: Message) -> bool:
     # Check new joined user
     result = False
 
-    glovar.locks["message"].acquire()
+    held = lock_message([message.chat.id], [new.id for new in message.new_chat_members])
 
     try:
         # Basic data
@@ -63,6 +63,9 @@ def hint(client: Client, message: Message) -> bool:
         mid = message.message_id
         now = message.date or get_now()
 
+        # Count the joins
+        add_join(gid, now, len([new for new in message.new_chat_members if not new.is_bot]))
+
         # Check the group status
         if is_flooded(gid):
             delete_message(client, gid, mid)
@@ -117,7 +120,7 @@ def hint(client: Client, message: Message) -> bool:
     except Exception as e:
         logger.warning(f"Hint error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        unlock_message(held)
 
     return result
 
@@ -130,7 +133,7 @@ def check(client: Client, message: Message) -> bool:
     # Check the messages sent from groups
     result = False
 
-    glovar.locks["message"].acquire()
+    held = lock_message([message.chat.id], [message.from_user.id])
 
     try:
         # Basic data
@@ -152,7 +155,7 @@ def check(client: Client, message: Message) -> bool:
     except Exception as e:
         logger.warning(f"Check error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        unlock_message(held)
 
     return result
 
@@ -165,7 +168,7 @@ def verify_ask(client: Client, message: Message) -> bool:
     # Check the messages sent from groups
     result = False
 
-    glovar.locks["message"].acquire()
+    held = lock_message(uids=[new.id for new in message.new_chat_members], waiting=True)
 
     try:
         # Basic data
@@ -215,7 +218,7 @@ def verify_ask(client: Client, message: Message) -> bool:
     except Exception as e:
         logger.warning(f"Verify ask error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        unlock_message(held)
 
     return result
 
@@ -227,7 +230,7 @@ def verify_check(client: Client, message: Message) -> bool:
     # Check the messages sent from the CAPTCHA group
     result = False
 
-    glovar.locks["message"].acquire()
+    held = lock_message(uids=[message.from_user.id], waiting=True)
 
     try:
         # Basic data
@@ -270,7 +273,7 @@ def verify_check(client: Client, message: Message) -> bool:
     except Exception as e:
         logger.warning(f"Verify check error: {e}", exc_info=True)
     finally:
-        glovar.locks["message"].release()
+        unlock_message(held)
         delete_normal_command(client, message)
 
     return result
@@ -315,7 +318,7 @@ def exchange_emergency(client: Client, message: Message) -> bool:
         text = (f"{lang('project')}{lang('colon')}{project_text}\n"
                 f"{lang('action')}{lang('colon')}{code(lang('transfer_channel'))}\n"
                 f"{lang('emergency_channel')}{lang('colon')}{code(hide_text)}\n")
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -357,7 +360,7 @@ def init_group(client: Client, message: Message) -> bool:
             else:
                 text += f"{lang('inviter')}{lang('colon')}{code(inviter.id)}\n"
 
-            return thread(send_message, (client, glovar.debug_channel_id, text))
+            return thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         # Remove the left status
         if gid in glovar.left_group_ids:
@@ -386,7 +389,7 @@ def init_group(client: Client, message: Message) -> bool:
             text += f"{lang('inviter')}{lang('colon')}{code(inviter.id)}\n"
 
         # Send debug message
-        thread(send_message, (client, glovar.debug_channel_id, text))
+        thread(send_message, (client, glovar.debug_channel_id, text), pool="debug")
 
         result = True
     except Exception as e:
@@ -0,0 +1,222 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Condition, Lock, local
+from time import perf_counter
+from typing import Any, Iterable, List, Optional, Set
+
+# Time the current thread has waited for locks, in seconds
+waited = local()
+
+# Lock order, outer first:
+#   1. locks["message"], shared for work inside known groups, exclusive for work across all groups
+#   2. group_locks stripes, in ascending index order
+#   3. user_locks stripes, in ascending index order
+#   4. the other entries of locks
+#   5. the locks of the conditions, deadline and delay, never held while waiting for another lock
+# The exclusive holder of locks["message"] takes no stripes, no stripe is held while it runs
+
+
+class RWLock:
+    # A lock shared by many readers or held by one writer, a waiting writer blocks new readers
+
+    def __init__(self):
+        self.condition = Condition(Lock())
+        self.held = local()
+        self.readers = 0
+        self.writer = False
+        self.writers = 0
+        self.count = 0
+        self.time = 0.0
+        self.max = 0.0
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        # Acquire the lock exclusively
+        with self.condition:
+            if not self.writer and not self.readers:
+                self.writer = True
+                self.hold(1)
+                return True
+
+            if not blocking:
+                return False
+
+            start = perf_counter()
+            self.writers += 1
+
+            try:
+                result = self.condition.wait_for(lambda: not self.writer and not self.readers,
+                                                 None if timeout < 0 else timeout)
+            finally:
+                self.writers -= 1
+
+            record_wait(self, perf_counter() - start)
+
+            if result:
+                self.writer = True
+                self.hold(1)
+            else:
+                self.condition.notify_all()
+
+            return result
+
+    def acquire_shared(self) -> bool:
+        # Acquire the lock shared with other readers
+        with self.condition:
+            if not self.writer and not self.writers:
+                self.readers += 1
+                self.hold(1)
+                return True
+
+            start = perf_counter()
+            self.condition.wait_for(lambda: not self.writer and not self.writers)
+            self.readers += 1
+            self.hold(1)
+            record_wait(self, perf_counter() - start)
+
+            return True
+
+    def hold(self, count: int) -> None:
+        # Count the holds of the current thread
+        self.held.count = getattr(self.held, "count", 0) + count
+
+    def is_held(self) -> bool:
+        # Check if the current thread holds the lock, shared or exclusively
+        return getattr(self.held, "count", 0) > 0
+
+    def locked(self) -> bool:
+        return self.writer or self.readers > 0
+
+    def release(self) -> None:
+        with self.condition:
+            self.writer = False
+            self.hold(-1)
+            self.condition.notify_all()
+
+    def release_shared(self) -> None:
+        with self.condition:
+            self.readers -= 1
+            self.hold(-1)
+            self.readers or self.condition.notify_all()
+
+
+class StripedLock:
+    # A fixed set of locks, each key maps to one of them, a thread takes several stripes in ascending order
+
+    def __init__(self, size: int = 64):
+        self.locks = [TimedLock() for _ in range(size)]
+        self.held = local()
+
+    def acquire(self, keys: Iterable[Any]) -> List[int]:
+        # Acquire the stripes of the keys that the thread does not hold yet, return their indexes
+        held = self.get_held()
+        result = sorted({self.index(key) for key in keys} - held)
+
+        for index in result:
+            self.locks[index].acquire()
+            held.add(index)
+
+        return result
+
+    def get_held(self) -> Set[int]:
+        # Get the indexes of the stripes held by the current thread
+        if not hasattr(self.held, "indexes"):
+            self.held.indexes = set()
+
+        return self.held.indexes
+
+    def index(self, key: Any) -> int:
+        return hash(key) % len(self.locks)
+
+    def release(self, indexes: List[int]) -> None:
+        # Release the stripes returned by acquire or try_acquire
+        held = self.get_held()
+
+        for index in reversed(indexes):
+            held.discard(index)
+            self.locks[index].release()
+
+    def try_acquire(self, key: Any) -> Optional[List[int]]:
+        # Acquire the stripe of the key out of order without waiting, return None if another thread holds it
+        index = self.index(key)
+        held = self.get_held()
+
+        if index in held:
+            return []
+
+        if not self.locks[index].acquire(False):
+            return None
+
+        held.add(index)
+
+        return [index]
+
+
+class TimedLock:
+    # A lock that records how long its acquirers waited for it
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.time = 0.0
+        self.max = 0.0
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        # Acquire the lock, only a contended acquire is timed
+        if self.lock.acquire(False):
+            return True
+
+        if not blocking:
+            return False
+
+        start = perf_counter()
+        result = self.lock.acquire(True, timeout)
+        record_wait(self, perf_counter() - start)
+
+        return result
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def release(self) -> None:
+        self.lock.release()
+
+
+def get_waited() -> float:
+    # Get the time the current thread has waited for locks
+    return getattr(waited, "time", 0.0)
+
+
+def record_wait(lock: Any, wait: float) -> None:
+    # Add a contended wait to the lock's totals and to the current thread
+    lock.count += 1
+    lock.time += wait
+    lock.max = max(lock.max, wait)
+    waited.time = get_waited() + wait
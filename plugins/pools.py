@@ -0,0 +1,213 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from asyncio import AbstractEventLoop, run_coroutine_threadsafe
+from concurrent.futures import Future
+from heapq import heappop, heappush
+from itertools import count
+from queue import Full, PriorityQueue
+from threading import Lock, Thread
+from typing import Callable, Dict, Optional
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+
+class BoundedPool:
+    # A named pool of worker threads with a bounded queue, lower priority values are taken first
+    # A full queue is handled by the policy:
+    #   block - wait up to timeout seconds for a free slot if the submitter may block, then spill the task
+    #   drop - reject the task
+    # A droppable task is rejected by either policy, a spilled task waits in the overflow list until a worker
+    # frees a slot in the queue, so no other task is lost
+    # A task never runs in the submitting thread, the submitter may hold locks that are not reentrant
+
+    def __init__(self, name: str, workers: int, size: int, policy: str = "block", timeout: float = 5.0):
+        self.name = name
+        self.workers = workers
+        self.policy = policy
+        self.timeout = timeout
+        self.queue = PriorityQueue(size)
+        self.spilled = []
+        self.order = count()
+        self.lock = Lock()
+        self.threads = 0
+        self.idle = 0
+        self.active = 0
+        self.peak = 0
+        self.submitted = 0
+        self.completed = 0
+        self.overflow = 0
+        self.rejected = 0
+
+    def get_status(self) -> Dict[str, int]:
+        # Get the utilization of the pool
+        return {
+            "workers": self.threads,
+            "active": self.active,
+            "queued": self.queue.qsize() + len(self.spilled),
+            "peak": self.peak,
+            "completed": self.completed,
+            "overflow": self.overflow,
+            "rejected": self.rejected
+        }
+
+    def run(self, target: Callable, args: tuple, kwargs: dict) -> None:
+        # Run a task, count it
+        with self.lock:
+            self.active += 1
+
+        try:
+            target(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Pool {self.name} task error: {e}", exc_info=True)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.completed += 1
+
+    def refill(self) -> None:
+        # Move spilled tasks to the queue while it has free slots, the caller holds the lock
+        try:
+            while self.spilled:
+                self.queue.put_nowait(self.spilled[0])
+                heappop(self.spilled)
+        except Full:
+            pass
+
+    def spill(self, task: tuple) -> None:
+        # Keep the task in the overflow list, unless the queue has a free slot again
+        with self.lock:
+            self.refill()
+
+            try:
+                self.queue.put_nowait(task)
+            except Full:
+                heappush(self.spilled, task)
+
+    def submit(self, target: Callable, args: tuple = (), kwargs: dict = None, priority: int = 0,
+               block: bool = True, drop: bool = False) -> bool:
+        # Run the target in the pool, return False if the task was rejected
+        # A submitter that holds a lock must not block, only a droppable task is rejected by the block policy
+        task = (priority, next(self.order), target, args, kwargs or {})
+
+        with self.lock:
+            self.submitted += 1
+
+            if self.threads < self.workers and self.queue.qsize() >= self.idle:
+                self.threads += 1
+                Thread(target=self.work, name=f"{self.name}-{self.threads}", daemon=True).start()
+
+        try:
+            self.queue.put_nowait(task)
+        except Full:
+            if self.policy == "drop" or drop:
+                with self.lock:
+                    self.rejected += 1
+
+                logger.warning(f"Pool {self.name} is full, {target.__name__} rejected")
+                return False
+
+            with self.lock:
+                self.overflow += 1
+
+            try:
+                if not block:
+                    raise
+
+                self.queue.put(task, timeout=self.timeout)
+            except Full:
+                self.spill(task)
+
+        self.peak = max(self.peak, self.queue.qsize() + len(self.spilled))
+
+        return True
+
+    def work(self) -> None:
+        # Take tasks from the queue forever
+        while True:
+            with self.lock:
+                self.idle += 1
+
+            task = self.queue.get()
+
+            with self.lock:
+                self.idle -= 1
+                self.refill()
+
+            self.run(*task[2:])
+
+
+class CoroutinePool:
+    # Coroutines run on the event loop of the client, a full pool leaves the call to the caller
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.loop: Optional[AbstractEventLoop] = None
+        self.lock = Lock()
+        self.active = 0
+        self.peak = 0
+        self.submitted = 0
+        self.completed = 0
+        self.overflow = 0
+
+    def done(self, future: Future) -> None:
+        # Count a finished coroutine
+        with self.lock:
+            self.active -= 1
+            self.completed += 1
+
+        if not future.cancelled() and future.exception():
+            logger.warning(f"Pool {self.name} task error: {future.exception()}")
+
+    def get_status(self) -> Dict[str, int]:
+        # Get the utilization of the pool, its workers belong to the event loop
+        return {
+            "workers": 0,
+            "active": self.active,
+            "queued": 0,
+            "peak": self.peak,
+            "completed": self.completed,
+            "overflow": self.overflow,
+            "rejected": 0
+        }
+
+    def start(self, loop: AbstractEventLoop) -> None:
+        # Accept coroutines on the loop
+        self.loop = loop
+
+    def submit(self, target: Callable, args: tuple = (), kwargs: dict = None, priority: int = 0) -> bool:
+        # Run the coroutine function on the loop, the loop has no queue to order by priority
+        # Return False if the pool is not running or full
+        with self.lock:
+            if not self.loop or not self.loop.is_running():
+                return False
+
+            if self.active >= self.size:
+                self.overflow += 1
+                return False
+
+            self.submitted += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+        run_coroutine_threadsafe(target(*args, **(kwargs or {})), self.loop).add_done_callback(self.done)
+
+        return True
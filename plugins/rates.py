@@ -0,0 +1,141 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Lock, local
+from typing import Dict, Optional, Union
+
+# Priority class of the API calls made by the current thread
+priority = local()
+
+
+class RateLimiter:
+    # A global token bucket and one bucket per chat, a call waits for both of them
+    # A call of a lower priority class only takes tokens while its wait is within the hold of the class
+
+    def __init__(self, rate: float, burst: float, chat_rate: float, chat_burst: float, size: int = 1024):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.size = size
+        self.chats: Dict[int, TokenBucket] = {}
+        self.lock = Lock()
+        self.calls = 0
+        self.delayed = 0
+        self.waited = 0.0
+        self.max = 0.0
+        self.shed = 0
+        self.floods = 0
+        self.flood_time = 0.0
+        self.levels: Dict[str, Dict[str, int]] = {}
+
+    def count(self, level: str, key: str) -> None:
+        # Count a call of the priority class
+        if level not in self.levels:
+            self.levels[level] = {"calls": 0, "deferred": 0, "shed": 0}
+
+        self.levels[level][key] += 1
+
+    def get_status(self) -> Dict[str, Union[float, int]]:
+        # Get the totals of the limiter
+        return {
+            "calls": self.calls,
+            "delayed": self.delayed,
+            "wait": round(self.waited / self.delayed, 3) if self.delayed else 0.0,
+            "max": round(self.max, 3),
+            "shed": self.shed,
+            "floods": self.floods,
+            "flood_time": self.flood_time,
+            "chats": len(self.chats)
+        }
+
+    def prune(self, now: float) -> None:
+        # Forget the chats whose buckets are full again
+        for cid in [cid for cid, bucket in self.chats.items() if bucket.refill(now) >= bucket.burst]:
+            self.chats.pop(cid, None)
+
+    def record_flood(self, secs: int) -> None:
+        # Count a FloodWait that the limiter did not prevent
+        with self.lock:
+            self.floods += 1
+            self.flood_time += secs
+
+    def reserve(self, now: float, count: int = 1, cid: int = 0, limit: float = -1,
+                hold: float = -1, level: str = "") -> Optional[float]:
+        # Take tokens for a call, return the seconds to wait before it, or None if the wait would exceed the limit
+        # If the wait exceeds the hold, take nothing and return the negative seconds until it is within the hold
+        with self.lock:
+            bucket = None
+
+            if cid:
+                bucket = self.chats.get(cid)
+
+                if bucket is None:
+                    len(self.chats) >= self.size and self.prune(now)
+                    bucket = self.chats[cid] = TokenBucket(self.chat_rate, self.chat_burst)
+
+            wait = max(self.bucket.get_wait(now, count), bucket.get_wait(now, count) if bucket else 0.0)
+
+            if 0 <= limit < wait:
+                self.shed += 1
+                level and self.count(level, "shed")
+                return None
+
+            if not count:
+                return wait
+
+            if 0 <= hold < wait:
+                level and self.count(level, "deferred")
+                return hold - wait
+
+            self.bucket.take(count)
+            bucket and bucket.take(count)
+
+            self.calls += 1
+            level and self.count(level, "calls")
+
+            if wait > 0:
+                self.delayed += 1
+                self.waited += wait
+                self.max = max(self.max, wait)
+
+            return wait
+
+
+class TokenBucket:
+    # Tokens refill at rate per second up to burst, a taken token may be owed, which queues later calls
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = 0.0
+
+    def get_wait(self, now: float, count: int = 1) -> float:
+        # Get the seconds until count tokens are free, a count of 0 gives the backlog
+        return max(0.0, (count - self.refill(now)) / self.rate)
+
+    def refill(self, now: float) -> float:
+        # Add the tokens earned since the last refill
+        if now > self.time:
+            self.tokens = min(self.burst, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+
+        return self.tokens
+
+    def take(self, count: int = 1) -> None:
+        self.tokens -= count
@@ -0,0 +1,474 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+# Keys of a user status record, in the order of glovar.default_user_status
+SCALAR_KEYS: Tuple[str, ...] = ("name", "type", "mid", "time", "answer", "limit", "try")
+DICT_KEYS: Tuple[str, ...] = ("join", "pass", "wait", "qns", "succeeded", "failed")
+SET_KEYS: Tuple[str, ...] = ("restricted", "banned", "manual")
+SCORE_KEYS: Tuple[str, ...] = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam", "warn")
+
+ALL_KEYS: Tuple[str, ...] = SCALAR_KEYS + DICT_KEYS + SET_KEYS + ("score",)
+SCALAR_DEFAULTS: Dict[str, Any] = {"name": "", "type": "", "mid": 0, "time": 0, "answer": "", "limit": 0, "try": 0}
+SCORE_INDEXES: Dict[str, int] = {key: i for i, key in enumerate(SCORE_KEYS)}
+SCORE_ZEROS: Dict[str, float] = {key: 0.0 for key in SCORE_KEYS}
+
+# Slot names, "pass" and "try" are keywords
+SLOTS: Dict[str, str] = {key: f"{key}_" for key in ALL_KEYS}
+
+
+class LazyDict(dict):
+    # A dict in a record, attaches itself to the record on the first write and marks the record as changed
+
+    __slots__ = ("owner", "key")
+
+    def __init__(self, owner: Optional["UserStatus"] = None, key: str = ""):
+        super().__init__()
+        self.owner = owner
+        self.key = key
+
+    def __delitem__(self, key: Any) -> None:
+        self.touch()
+        super().__delitem__(key)
+
+    def __ior__(self, other: Any) -> "LazyDict":
+        self.touch()
+        return super().__ior__(other)
+
+    def __reduce__(self) -> tuple:
+        return dict, (dict(self),)
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.touch()
+        super().__setitem__(key, value)
+
+    def clear(self) -> None:
+        self and self.touch()
+        super().clear()
+
+    def pop(self, key: Any, *args: Any) -> Any:
+        key in self and self.touch()
+        return super().pop(key, *args)
+
+    def popitem(self) -> tuple:
+        self.touch()
+        return super().popitem()
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        key not in self and self.touch()
+        return super().setdefault(key, default)
+
+    def touch(self) -> None:
+        # Mark the record as changed, store this container in the record
+        touch(self)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        self.touch()
+        super().update(*args, **kwargs)
+
+
+class JoinHistory(LazyDict):
+    # The groups a user joined and the join times, oldest first, only the latest joins are kept
+
+    __slots__ = ()
+
+    # Set from the track limit when the data is loaded
+    capacity: int = 16
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        # A new join moves the group to the end
+        self.touch()
+        dict.pop(self, key, None)
+        dict.__setitem__(self, key, value)
+
+        while len(self) > self.capacity:
+            dict.__delitem__(self, next(iter(self)))
+
+    def count_since(self, time: int, limit: int = 0) -> int:
+        # Count the groups joined at or after the time, from the latest, stop at the limit
+        result = 0
+
+        for value in reversed(self.values()):
+            if value < time or (limit and result >= limit):
+                break
+
+            result += 1
+
+        return result
+
+    def fill(self, data: Dict[Any, Any]) -> None:
+        # Load joins without marking the record as changed
+        for key, value in sorted(data.items(), key=lambda item: item[1])[-self.capacity:]:
+            dict.__setitem__(self, key, value)
+
+    def latest(self) -> int:
+        # Get the time of the latest join
+        return next(reversed(self.values()), 0)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+class LazySet(set):
+    # A set in a record, attaches itself to the record on the first write and marks the record as changed
+
+    __slots__ = ("owner", "key")
+
+    def __init__(self, owner: Optional["UserStatus"] = None, key: str = ""):
+        super().__init__()
+        self.owner = owner
+        self.key = key
+
+    def __iand__(self, other: Any) -> "LazySet":
+        self.touch()
+        return super().__iand__(other)
+
+    def __ior__(self, other: Any) -> "LazySet":
+        self.touch()
+        return super().__ior__(other)
+
+    def __isub__(self, other: Any) -> "LazySet":
+        self and self.touch()
+        return super().__isub__(other)
+
+    def __ixor__(self, other: Any) -> "LazySet":
+        self.touch()
+        return super().__ixor__(other)
+
+    def __reduce__(self) -> tuple:
+        return set, (set(self),)
+
+    def add(self, element: Any) -> None:
+        element not in self and self.touch()
+        super().add(element)
+
+    def clear(self) -> None:
+        self and self.touch()
+        super().clear()
+
+    def difference_update(self, *args: Any) -> None:
+        self and self.touch()
+        super().difference_update(*args)
+
+    def discard(self, element: Any) -> None:
+        element in self and self.touch()
+        super().discard(element)
+
+    def intersection_update(self, *args: Any) -> None:
+        self and self.touch()
+        super().intersection_update(*args)
+
+    def pop(self) -> Any:
+        self.touch()
+        return super().pop()
+
+    def remove(self, element: Any) -> None:
+        self.touch()
+        super().remove(element)
+
+    def symmetric_difference_update(self, other: Any) -> None:
+        self.touch()
+        super().symmetric_difference_update(other)
+
+    def touch(self) -> None:
+        # Mark the record as changed, store this container in the record
+        touch(self)
+
+    def update(self, *args: Any) -> None:
+        self.touch()
+        super().update(*args)
+
+
+class ScoreView:
+    # A dict view of the packed score vector
+
+    __slots__ = ("owner",)
+
+    def __init__(self, owner: "UserStatus"):
+        self.owner = owner
+
+    def __contains__(self, key: Any) -> bool:
+        return key in SCORE_INDEXES or key in (self.owner.others_ or ())
+
+    def __getitem__(self, key: str) -> float:
+        index = SCORE_INDEXES.get(key)
+
+        if index is None:
+            return (self.owner.others_ or {})[key]
+
+        return self.owner.score_[index] if self.owner.score_ else 0.0
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(SCORE_KEYS) + len(self.owner.others_ or ())
+
+    def __reduce__(self) -> tuple:
+        return dict, (dict(self.items()),)
+
+    def __setitem__(self, key: str, value: float) -> None:
+        index = SCORE_INDEXES.get(key)
+        self.owner.dirty_ = True
+
+        if index is not None:
+            if not self.owner.score_ and not value:
+                return
+
+            if not self.owner.score_:
+                self.owner.score_ = array("d", bytes(8 * len(SCORE_KEYS)))
+
+            self.owner.score_[index] = value
+        else:
+            if self.owner.others_ is None:
+                self.owner.others_ = {}
+
+            self.owner.others_[key] = value
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def items(self) -> list:
+        return [(key, self[key]) for key in self.keys()]
+
+    def keys(self) -> list:
+        return list(SCORE_KEYS) + list(self.owner.others_ or ())
+
+    def values(self) -> list:
+        return [self[key] for key in self.keys()]
+
+
+class UserStatus:
+    # A compact user status record with the same item access as glovar.default_user_status
+
+    __slots__ = tuple(SLOTS.values()) + ("others_", "dirty_")
+
+    def __init__(self):
+        for key in SCALAR_KEYS:
+            setattr(self, SLOTS[key], SCALAR_DEFAULTS[key])
+
+        for key in DICT_KEYS + SET_KEYS + ("score",):
+            setattr(self, SLOTS[key], None)
+
+        self.others_ = None
+        self.dirty_ = True
+
+    def __contains__(self, key: Any) -> bool:
+        return key in SLOTS
+
+    def __getitem__(self, key: str) -> Any:
+        slot = SLOTS[key]
+
+        if key == "score":
+            return ScoreView(self)
+
+        value = getattr(self, slot)
+
+        if value is not None:
+            return value
+
+        if key == "join":
+            return JoinHistory(self, key)
+
+        if key in DICT_KEYS:
+            return LazyDict(self, key)
+
+        return LazySet(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(ALL_KEYS)
+
+    def __len__(self) -> int:
+        return len(ALL_KEYS)
+
+    def __reduce__(self) -> tuple:
+        # Pickle and copy as a plain dict, so the data files stay readable without this class
+        return dict, (self.to_dict(),)
+
+    def __repr__(self) -> str:
+        return f"UserStatus({self.to_dict()!r})"
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        slot = SLOTS[key]
+        self.dirty_ = True
+
+        if key == "score":
+            view = ScoreView(self)
+
+            for k in value:
+                view[k] = value[k]
+        elif key in SCALAR_KEYS:
+            setattr(self, slot, value)
+        elif not value:
+            setattr(self, slot, None)
+        elif isinstance(value, (LazyDict, LazySet)) and value.owner is self:
+            setattr(self, slot, value)
+        elif key == "join":
+            container = JoinHistory(self, key)
+            container.fill(value)
+            setattr(self, slot, container)
+        elif key in DICT_KEYS:
+            container = LazyDict(self, key)
+            dict.update(container, value)
+            setattr(self, slot, container)
+        else:
+            container = LazySet(self, key)
+            set.update(container, value)
+            setattr(self, slot, container)
+
+    @classmethod
+    def from_dict(cls, data: Union[Dict[str, Any], tuple]) -> "UserStatus":
+        # Convert a plain dict record
+        if isinstance(data, cls):
+            return data
+
+        if isinstance(data, tuple):
+            return cls.from_tuple(data)
+
+        result = cls()
+
+        for key in data:
+            if key not in SLOTS:
+                continue
+
+            result[key] = data[key]
+
+        return result
+
+    @classmethod
+    def from_tuple(cls, data: tuple) -> "UserStatus":
+        # Convert a record written by to_tuple
+        result = cls.__new__(cls)
+        values = iter(data)
+
+        for key in SCALAR_KEYS:
+            setattr(result, SLOTS[key], next(values))
+
+        # An empty container is stored as None, like an unused one
+        for key in DICT_KEYS:
+            value = next(values)
+
+            if not value:
+                setattr(result, SLOTS[key], None)
+            elif key == "join":
+                setattr(result, SLOTS[key], JoinHistory(result, key))
+                result.join_.fill(value)
+            else:
+                setattr(result, SLOTS[key], LazyDict(result, key))
+                dict.update(getattr(result, SLOTS[key]), value)
+
+        for key in SET_KEYS:
+            value = next(values)
+
+            if not value:
+                setattr(result, SLOTS[key], None)
+            else:
+                setattr(result, SLOTS[key], LazySet(result, key))
+                set.update(getattr(result, SLOTS[key]), value)
+
+        score = next(values)
+        others = next(values)
+        result.score_ = array("d", score) if score else None
+        result.others_ = dict(others) if others else None
+        result.dirty_ = True
+
+        return result
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in SLOTS else default
+
+    def has_state(self) -> bool:
+        # Check if the record holds a pass, punishment or manual state, it is kept longer than an idle record
+        return bool(self.pass_ or self.restricted_ or self.banned_ or self.manual_)
+
+    def is_active(self) -> bool:
+        # Check if the record holds a challenge state that must be kept until its deadline
+        return bool(self.time_ or self.wait_ or (self.failed_ and any(self.failed_.values())))
+
+    def items(self) -> list:
+        return [(key, self[key]) for key in ALL_KEYS]
+
+    def keys(self) -> list:
+        return list(ALL_KEYS)
+
+    def last_time(self) -> int:
+        # Get the time of the latest recorded activity
+        result = self.time_ or 0
+
+        for container in (self.join_, self.pass_, self.wait_, self.succeeded_, self.failed_):
+            if not container:
+                continue
+
+            result = max(result, max(abs(value) for value in container.values()))
+
+        return result
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Get a plain dict record
+        score = dict(zip(SCORE_KEYS, self.score_)) if self.score_ else dict(SCORE_ZEROS)
+        self.others_ and score.update(self.others_)
+
+        return {
+            "name": self.name_,
+            "type": self.type_,
+            "mid": self.mid_,
+            "time": self.time_,
+            "answer": self.answer_,
+            "limit": self.limit_,
+            "try": self.try_,
+            "join": dict(self.join_) if self.join_ else {},
+            "pass": dict(self.pass_) if self.pass_ else {},
+            "wait": dict(self.wait_) if self.wait_ else {},
+            "qns": dict(self.qns_) if self.qns_ else {},
+            "succeeded": dict(self.succeeded_) if self.succeeded_ else {},
+            "failed": dict(self.failed_) if self.failed_ else {},
+            "restricted": set(self.restricted_) if self.restricted_ else set(),
+            "banned": set(self.banned_) if self.banned_ else set(),
+            "manual": set(self.manual_) if self.manual_ else set(),
+            "score": score
+        }
+
+    def to_tuple(self) -> tuple:
+        # Get a record of builtin types in the slot order, for compact serializing
+        # An emptied container is written as None, marshal cannot encode the container subclasses
+        return (self.name_, self.type_, self.mid_, self.time_, self.answer_, self.limit_, self.try_,
+                dict(self.join_) if self.join_ else None, dict(self.pass_) if self.pass_ else None,
+                dict(self.wait_) if self.wait_ else None, dict(self.qns_) if self.qns_ else None,
+                dict(self.succeeded_) if self.succeeded_ else None, dict(self.failed_) if self.failed_ else None,
+                set(self.restricted_) if self.restricted_ else None, set(self.banned_) if self.banned_ else None,
+                set(self.manual_) if self.manual_ else None,
+                self.score_.tobytes() if self.score_ else None, dict(self.others_) if self.others_ else None)
+
+    def values(self) -> list:
+        return [self[key] for key in self.keys()]
+
+
+def touch(container: Union[LazyDict, LazySet]) -> None:
+    # Mark the owner of the container as changed, store the container in the owner
+    owner = container.owner
+
+    if owner is None:
+        return
+
+    owner.dirty_ = True
+
+    if getattr(owner, SLOTS[container.key]) is not container:
+        setattr(owner, SLOTS[container.key], container)
@@ -0,0 +1,282 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import marshal
+from collections.abc import MutableMapping
+from glob import glob
+from hashlib import blake2b
+from os import fsync, replace
+from pickle import HIGHEST_PROTOCOL, UnpicklingError, dump, dumps, load, loads
+from sqlite3 import connect
+from threading import Lock
+from typing import Any, BinaryIO, Dict, Iterator, List, Set, Tuple
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# Header of the data files written with marshal, a pickle starts with the PROTO opcode instead
+MARSHAL_MAGIC = b"SCP079M\x01"
+
+
+class UserStore(MutableMapping):
+    # User status records kept in a SQLite database, one row per user
+
+    def __init__(self, path: str):
+        # Open the database, load all records into memory
+        self.path = path
+        self.records: Dict[int, Any] = {}
+        self.digests: Dict[int, bytes] = {}
+        self.touched: Set[int] = set()
+        self.deleted: Set[int] = set()
+        self.lock = Lock()
+
+        self.connection = connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, data BLOB NOT NULL)")
+
+        for uid, blob in self.connection.execute("SELECT uid, data FROM users"):
+            self.records[uid] = loads(blob)
+            self.digests[uid] = get_digest(blob)
+
+    def __contains__(self, uid: Any) -> bool:
+        return uid in self.records
+
+    def __delitem__(self, uid: int) -> None:
+        del self.records[uid]
+        self.touched.discard(uid)
+        self.deleted.add(uid)
+
+    def __getitem__(self, uid: int) -> Any:
+        # Records are mutated in place, so every access may be a change
+        record = self.records[uid]
+        self.touched.add(uid)
+        return record
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __reduce__(self) -> tuple:
+        # Pickle and copy as a plain dict
+        return dict, (dict(self.records),)
+
+    def __setitem__(self, uid: int, record: Any) -> None:
+        self.records[uid] = record
+        self.touched.add(uid)
+        self.deleted.discard(uid)
+
+    def clear(self) -> None:
+        # Remove all records
+        for uid in list(self.records):
+            del self[uid]
+
+    def close(self) -> None:
+        # Write the changed records, close the database
+        self.commit()
+        self.connection.close()
+
+    def commit(self) -> int:
+        # Write the changed records to the database, return the count of written rows
+        with self.lock:
+            touched, self.touched = self.touched, set()
+            deleted, self.deleted = self.deleted, set()
+
+            rows = []
+            digests = {}
+
+            for uid in touched:
+                record = self.records.get(uid)
+
+                if record is None:
+                    continue
+
+                try:
+                    blob = dumps(record, HIGHEST_PROTOCOL)
+                except RuntimeError:
+                    # Changed during pickling, try again next time
+                    self.touched.add(uid)
+                    continue
+
+                digest = get_digest(blob)
+
+                if self.digests.get(uid) == digest:
+                    continue
+
+                rows.append((uid, blob))
+                digests[uid] = digest
+
+            deleted = [uid for uid in deleted if uid not in self.records and uid in self.digests]
+
+            if not rows and not deleted:
+                return 0
+
+            try:
+                with self.connection:
+                    self.connection.execute("BEGIN")
+                    self.connection.executemany("INSERT OR REPLACE INTO users (uid, data) VALUES (?, ?)", rows)
+                    self.connection.executemany("DELETE FROM users WHERE uid = ?", [(uid,) for uid in deleted])
+            except Exception:
+                self.touched.update(digests)
+                self.deleted.update(deleted)
+                raise
+
+            self.digests.update(digests)
+
+            for uid in deleted:
+                self.digests.pop(uid, None)
+
+            return len(rows) + len(deleted)
+
+    def replace(self, data: Dict[int, Any]) -> None:
+        # Replace all records with the data
+        self.clear()
+        self.update(data)
+
+
+def append_journal(path: str, records: List[Tuple[str, Any, bytes]]) -> None:
+    # Append mutation records to the journal
+    with open(path, "ab") as f:
+        for record in records:
+            dump(record, f, HIGHEST_PROTOCOL)
+
+        f.flush()
+        fsync(f.fileno())
+
+
+def dumps_data(data: Any, fast: bool = False) -> bytes:
+    # Serialize the data, use marshal if fast and the data only holds builtin types, otherwise pickle
+    if fast:
+        try:
+            # User status records are written as tuples in the slot order
+            if isinstance(data, dict):
+                data = {key: value.to_tuple() if hasattr(value, "to_tuple") else value
+                        for key, value in list(data.items())}
+
+            return MARSHAL_MAGIC + marshal.dumps(data)
+        except ValueError:
+            pass
+
+    return dumps(data, HIGHEST_PROTOCOL)
+
+
+def get_digest(blob: bytes) -> bytes:
+    # Get the digest of a stored record
+    return blake2b(blob, digest_size=16).digest()
+
+
+def get_shard_paths(file: str) -> Dict[int, str]:
+    # Get the shard files of a data file, index -> path
+    result = {}
+
+    for path in glob(f"data/{file}.*"):
+        index = path.split(".")[-1]
+
+        if not index.isdigit():
+            continue
+
+        result[int(index)] = path
+
+    return result
+
+
+def load_shards(file: str) -> Dict[Any, Any]:
+    # Merge all shard files of a data file
+    result = {}
+
+    for path in get_shard_paths(file).values():
+        with open(path, "rb") as f:
+            result.update(read_data(f))
+
+    return result
+
+
+def loads_data(blob: bytes) -> Any:
+    # Deserialize the data
+    if blob.startswith(MARSHAL_MAGIC):
+        return marshal.loads(blob[len(MARSHAL_MAGIC):])
+
+    return loads(blob)
+
+
+def migrate(data: Dict[int, Any], path: str) -> UserStore:
+    # Open the database, copy user status records from the pickled dict if the database is empty
+    store = UserStore(path)
+
+    if len(store) or not data:
+        return store
+
+    store.update(data)
+    count = store.commit()
+    logger.warning(f"Migrated {count} user(s) to {path}")
+
+    return store
+
+
+def read_data(f: BinaryIO) -> Any:
+    # Read the data from a file, written either by marshal or by pickle
+    return loads_data(f.read())
+
+
+def replay_journal(data: Dict[Any, Any], path: str, base: bytes = None) -> int:
+    # Apply the mutation records in the journal to the data, return the count of applied records
+    # A journal starts with the digest of the snapshot it follows, it is skipped if the snapshot is newer
+    count = 0
+
+    with open(path, "rb") as f:
+        while True:
+            try:
+                action, key, blob = load(f)
+            except EOFError:
+                break
+            except (UnpicklingError, ValueError) as e:
+                logger.warning(f"Replay journal {path} stopped at record {count}: {e}")
+                break
+
+            if action == "base" and base is not None and blob != base:
+                logger.warning(f"Replay journal {path} skipped, the snapshot is newer")
+                break
+
+            if action == "set":
+                data[key] = loads(blob)
+            elif action == "del":
+                data.pop(key, None)
+            else:
+                continue
+
+            count += 1
+
+    return count
+
+
+def write_atomic(path: str, blob: bytes) -> None:
+    # Write the file through a temporary file, a crash leaves either the old or the new file
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(blob)
+        f.flush()
+        fsync(f.fileno())
+
+    replace(f"{path}.tmp", path)
+
+
+def write_data(data: Any, f: BinaryIO, fast: bool = False) -> None:
+    # Write the data to a file
+    f.write(dumps_data(data, fast))
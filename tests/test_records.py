@@ -0,0 +1,66 @@
+# SCP-079-CAPTCHA - Provide challenges for newly joined members
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-CAPTCHA.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from plugins.records import LazyDict, LazySet, UserStatus
+from plugins.storage import MARSHAL_MAGIC, read_data, write_data
+
+
+def get_record() -> UserStatus:
+    # Get a record whose containers were written and then emptied
+    result = UserStatus()
+    result["name"] = "User"
+    result["join"][-1001] = 1580000000
+    result["pass"][-1001] = 1580000000
+    result["pass"].pop(-1001)
+    result["restricted"].add(-1001)
+    result["restricted"].discard(-1001)
+    result["score"]["captcha"] = 0.5
+
+    return result
+
+
+def test_emptied_containers_use_marshal(tmp_path) -> None:
+    path = tmp_path / "user_ids"
+
+    with open(path, "wb") as f:
+        write_data({1: get_record()}, f, True)
+
+    with open(path, "rb") as f:
+        assert f.read().startswith(MARSHAL_MAGIC)
+
+    with open(path, "rb") as f:
+        record = UserStatus.from_tuple(read_data(f)[1])
+
+    assert record.to_dict() == get_record().to_dict()
+
+
+def test_from_tuple_tracks_containers() -> None:
+    record = UserStatus.from_tuple(get_record().to_tuple())
+
+    assert record.pass_ is None and record.restricted_ is None
+
+    record["pass"][-1002] = 1580000001
+    record["restricted"].add(-1002)
+
+    assert isinstance(record.pass_, LazyDict) and record.pass_ == {-1002: 1580000001}
+    assert isinstance(record.restricted_, LazySet) and record.restricted_ == {-1002}
+
+    record = UserStatus.from_tuple(UserStatus().to_tuple())
+    record["wait"][-1003] = 1580000002
+
+    assert record.wait_ == {-1003: 1580000002}